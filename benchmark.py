@@ -0,0 +1,668 @@
+"""
+Offline benchmark for restrict_bot: no Telegram, no MongoDB.
+
+Drives the real start_task_final -> process_links_logic -> handle_private
+path, the Database methods, make_file_slices and the link parser (checked
+against a generated round-trip corpus) against stand-ins:
+
+  * FakeClient   - pyrogram Client look-alike with per-call latency, a
+                   bandwidth cap for media and random FloodWait injection
+  * FakeCollection - motor-compatible in-memory collection (the subset
+                   Database uses) with a configurable round-trip time
+
+Usage:
+    python benchmark.py                       # every scenario
+    python benchmark.py -s public -s users    # pick scenarios
+    python benchmark.py --latency 0.05 --flood-rate 0.01 --paced
+    python benchmark.py -s restricted --pipeline-depth 1   # sequential baseline
+    python benchmark.py -s restricted --no-stream          # disk path
+    python benchmark.py -s restricted --connections 4      # parallel getFile/saveFilePart
+    python benchmark.py -s mongo --mongo-uri mongodb://localhost:27017   # users index, real mongod
+
+Reports items/s, MB/s, peak RSS and event-loop lag per scenario. The mongo
+scenario is the exception: it needs a real mongod (--mongo-uri), seeds
+--mongo-users users into a scratch database and reports user lookup and
+session count latency without and with Database.ensure_indexes().
+The restricted scenario runs the default streaming path (getFile chunks and
+saveFilePart parts on FakeSession media connections + SendMedia), with
+--connections sessions per direction (1 = single connection).
+The upload scenario drives parallel_upload itself over FakeSession media
+connections, 1 vs N.
+"""
+import os
+import time
+import random
+import asyncio
+import inspect
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+# restrict_bot reads its config at import time
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "1:benchmark")
+os.environ.setdefault("DB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+os.environ.setdefault("LOGIN_SYSTEM", "False")
+os.environ.setdefault("RANGE_PRESCAN", "False")  # raw getHistory paging is not faked
+os.environ.setdefault("LOG_CHANNEL", "")
+
+import psutil
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+
+import restrict_bot as bot
+
+MB = 1024 * 1024
+ZERO_CHUNK = bytes(MB)
+
+# ==============================================================================
+# --- FAKE MONGO ---
+# ==============================================================================
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key) or 0, reverse=direction < 0)
+        return self
+
+    def __aiter__(self):
+        self._iter = iter(self._docs)
+        return self
+
+    async def __anext__(self):
+        try: return next(self._iter)
+        except StopIteration: raise StopAsyncIteration
+
+class FakeCollection:
+    """In-memory stand-in for the motor collection calls Database makes."""
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt
+        self.docs = []
+
+    async def _roundtrip(self):
+        await asyncio.sleep(self.rtt)
+
+    @staticmethod
+    def _match(doc, query):
+        for key, cond in query.items():
+            value = doc.get(key)
+            if isinstance(cond, dict) and "$type" in cond:
+                if cond["$type"] == "string" and not isinstance(value, str): return False
+            elif value != cond:
+                return False
+        return True
+
+    def _find(self, query):
+        return next((d for d in self.docs if self._match(d, query)), None)
+
+    async def create_index(self, *args, **kwargs):
+        await self._roundtrip()
+
+    async def find_one(self, query, projection=None):
+        await self._roundtrip()
+        doc = self._find(query)
+        return dict(doc) if doc else None
+
+    def find(self, query=None):
+        return FakeCursor([dict(d) for d in self.docs if self._match(d, query or {})])
+
+    async def update_one(self, query, update, upsert=False):
+        await self._roundtrip()
+        doc = self._find(query)
+        upserted_id = None
+        if doc is None:
+            if not upsert: return SimpleNamespace(upserted_id=None, modified_count=0)
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            doc.update(update.get("$setOnInsert", {}))
+            doc.setdefault("_id", len(self.docs) + 1)
+            self.docs.append(doc)
+            upserted_id = doc["_id"]
+        doc.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        return SimpleNamespace(upserted_id=upserted_id, modified_count=1)
+
+    async def delete_one(self, query):
+        await self._roundtrip()
+        doc = self._find(query)
+        if doc is not None: self.docs.remove(doc)
+
+    async def delete_many(self, query):
+        await self._roundtrip()
+        self.docs = [d for d in self.docs if not self._match(d, query)]
+
+    async def count_documents(self, query):
+        await self._roundtrip()
+        return sum(1 for d in self.docs if self._match(d, query))
+
+def install_fake_db(rtt):
+    bot.db.col = FakeCollection(rtt)
+    bot.db.tasks = FakeCollection(rtt)
+    bot.db.media = FakeCollection(rtt)
+    bot.db._user_cache = bot.AsyncTTLCache()
+    bot.db._media_cache = bot.AsyncTTLCache()
+
+# ==============================================================================
+# --- FAKE TELEGRAM ---
+# ==============================================================================
+
+PUBLIC_CHAT = "benchpublic"
+RESTRICTED_CHAT = -1001234567
+
+class FakeStatus:
+    """Status/context message: enough surface for process_links_logic and ProgressHub."""
+    def __init__(self, chat_id, msg_id, user_id=0):
+        self.id = msg_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=user_id, is_bot=False, mention=f"User({user_id})")
+        self.message_thread_id = None
+
+    async def edit_text(self, *args, **kwargs): return self
+    async def edit(self, *args, **kwargs): return self
+    async def delete(self, *args, **kwargs): return True
+    async def reply(self, *args, **kwargs): return self
+    async def reply_text(self, *args, **kwargs): return self
+
+class FakeStorage:
+    async def dc_id(self): return 2
+    async def test_mode(self): return False
+
+class FakeSession:
+    """Media session stand-in: every part costs a round trip plus size/bandwidth on its own connection."""
+    def __init__(self, client):
+        self.client = client
+
+    async def invoke(self, request):
+        if isinstance(request, raw.functions.upload.GetFile):
+            size = max(0, min(request.limit, self.client.file_size - request.offset))
+            await self.client._rpc(size)
+            self.client.bytes_moved += size
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=ZERO_CHUNK[:size])
+        size = len(getattr(request, "bytes", b""))
+        await self.client._rpc(size)
+        self.client.bytes_moved += size
+
+    async def stop(self):
+        pass
+
+class FakeMediaSessions:
+    """MEDIA_SESSIONS stand-in handing out FakeSessions."""
+    async def acquire(self, client, dc_id, count):
+        return [FakeSession(client) for _ in range(max(1, count))]
+
+    async def release(self, client, dc_id, sessions, broken=False):
+        pass
+
+class FakeParser:
+    async def parse(self, text, mode=None):
+        return {"message": text, "entities": None}
+
+async def _call_progress(progress, size, progress_args):
+    # Like pyrogram: the bot's progress() is a plain function, coroutine callbacks are awaited
+    if progress:
+        result = progress(size, size, *progress_args)
+        if inspect.isawaitable(result):
+            await result
+
+class FakeClient:
+    """
+    Answers the pyrogram calls the bot makes. Every call costs `latency`
+    seconds; media moves at `bandwidth` bytes/s; `flood_rate` of the calls
+    raise FloodWait(`flood_seconds`).
+    """
+    def __init__(self, latency=0.01, bandwidth=1000 * MB, flood_rate=0.0, flood_seconds=1, file_size=2 * 1024 * MB):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.file_size = file_size
+        self.me = SimpleNamespace(id=1, is_premium=True)
+        self.delivered = 0
+        self.uploads = 0
+        self.bytes_moved = 0
+        self._next_id = 1
+        self.storage = FakeStorage()
+        self.parser = FakeParser()
+
+    async def _rpc(self, size=0):
+        await asyncio.sleep(self.latency + (size / self.bandwidth if size else 0))
+        if self.flood_rate and random.random() < self.flood_rate:
+            raise FloodWait(value=self.flood_seconds)
+
+    async def _transfer(self, size, chunk):
+        # One connection: a round trip per getFile chunk / saveFilePart part, sequentially
+        await self._rpc(size)
+        await asyncio.sleep(self.latency * (max(1, -(-size // chunk)) - 1))
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def rnd_id(self):
+        return random.getrandbits(63)
+
+    def _message(self, chat_id, msg_id):
+        protected = chat_id == RESTRICTED_CHAT
+        msg = SimpleNamespace(
+            id=msg_id, empty=False, media_group_id=None, has_protected_content=protected,
+            chat=SimpleNamespace(id=chat_id, has_protected_content=protected),
+            text=None, entities=None, caption=f"item {msg_id}",
+            document=None, video=None, animation=None, sticker=None, voice=None, audio=None, photo=None
+        )
+        if protected:
+            file_id = FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=msg_id, access_hash=msg_id, file_reference=b"").encode()
+            msg.document = SimpleNamespace(
+                file_id=file_id, file_unique_id=f"u-{chat_id}-{msg_id}", file_name=f"file_{msg_id}.bin",
+                file_size=self.file_size, mime_type="application/octet-stream", thumbs=[]
+            )
+        else:
+            msg.text = f"message {msg_id}"
+        return msg
+
+    def _sent(self, chat_id, kind=None, size=0):
+        msg = self._message(chat_id, self._new_id())
+        if kind:
+            msg.text = None
+            setattr(msg, kind, SimpleNamespace(file_id=f"bot-{msg.id}", file_unique_id=f"sent-{msg.id}", file_size=size, thumbs=[]))
+        return msg
+
+    async def get_me(self):
+        return self.me
+
+    async def get_users(self, user_id):
+        await self._rpc()
+        return SimpleNamespace(id=user_id, mention=f"User({user_id})")
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._rpc()
+        if isinstance(message_ids, int):
+            return self._message(chat_id, message_ids)
+        return [self._message(chat_id, i) for i in message_ids]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._rpc()
+        self.delivered += 1
+        return FakeStatus(chat_id, self._new_id())
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._rpc()
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._rpc()
+        self.delivered += 1
+        return self._sent(chat_id)
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids, **kwargs):
+        await self._rpc()
+        self.delivered += len(message_ids)
+        return [self._sent(chat_id) for _ in message_ids]
+
+    async def send_cached_media(self, chat_id, file_id, **kwargs):
+        await self._rpc()
+        self.delivered += 1
+        return self._sent(chat_id)
+
+    async def download_media(self, message, file_name=None, progress=None, progress_args=(), in_memory=False):
+        media = getattr(message, "document", None)
+        size = media.file_size if media else 0
+        await self._transfer(size, MB)
+        # Sparse file: the bytes cost no real disk I/O
+        with open(file_name, "wb") as f:
+            f.truncate(size)
+        self.bytes_moved += size
+        await _call_progress(progress, size, progress_args)
+        return file_name
+
+    async def _upload(self, chat_id, path, kind, progress=None, progress_args=()):
+        size = os.path.getsize(path)
+        await self._transfer(size, MB // 2)
+        self.bytes_moved += size
+        self.delivered += 1
+        self.uploads += 1
+        await _call_progress(progress, size, progress_args)
+        return self._sent(chat_id, kind, size)
+
+    async def send_document(self, chat_id, document, progress=None, progress_args=(), **kwargs):
+        return await self._upload(chat_id, document, "document", progress, progress_args)
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self._upload(chat_id, video, "video", progress, progress_args)
+
+    async def send_audio(self, chat_id, audio, progress=None, progress_args=(), **kwargs):
+        return await self._upload(chat_id, audio, "audio", progress, progress_args)
+
+    async def stream_media(self, message, limit=0, offset=0):
+        # A getFile round trip per 1 MB chunk at the bandwidth cap
+        size = message.document.file_size
+        sent = 0
+        while sent < size:
+            n = min(MB, size - sent)
+            await self._rpc(n)
+            sent += n
+            self.bytes_moved += n
+            yield ZERO_CHUNK if n == MB else ZERO_CHUNK[:n]
+
+    async def resolve_peer(self, chat_id):
+        return chat_id
+
+    async def invoke(self, request):
+        if isinstance(request, (raw.functions.upload.SaveFilePart, raw.functions.upload.SaveBigFilePart)):
+            await self._rpc(len(request.bytes))
+            self.bytes_moved += len(request.bytes)
+            return True
+        if isinstance(request, raw.functions.messages.SendMedia):
+            await self._rpc()
+            self.delivered += 1
+            self.uploads += 1
+            return raw.types.Updates(updates=[], users=[], chats=[], date=0, seq=0)
+        raise NotImplementedError(type(request).__name__)
+
+# ==============================================================================
+# --- PROBES ---
+# ==============================================================================
+
+class LoopProbe:
+    """Samples event-loop lag (sleep overshoot) and process RSS while a scenario runs."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.peak_rss = 0
+        self._task = None
+
+    async def _run(self):
+        proc = psutil.Process()
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+            self.peak_rss = max(self.peak_rss, proc.memory_info().rss)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def lag(self, pct):
+        if not self.lags: return 0.0
+        ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def report(name, items, seconds, nbytes, probe):
+    print(
+        f"{name:<12} {items:>7} items  {items / seconds:>9.1f} items/s  "
+        f"{nbytes / MB / seconds:>9.1f} MB/s  peak RSS {probe.peak_rss / MB:>7.1f} MB  "
+        f"loop lag p99 {probe.lag(0.99) * 1000:>6.1f} ms / max {max(probe.lags or [0]) * 1000:>6.1f} ms  "
+        f"({seconds:.2f}s)"
+    )
+
+# ==============================================================================
+# --- SCENARIOS ---
+# ==============================================================================
+
+async def wait_idle():
+    await asyncio.sleep(0)
+    while bot.SCHEDULER.running() or bot.SCHEDULER.queued():
+        await asyncio.sleep(0.05)
+
+async def run_batches(client, acc, links, is_restricted):
+    """Submits one batch per (user_id, link) through the real scheduler and waits for all of them."""
+    bot.GlobalUserSession = acc
+    for user_id, link in links:
+        context = FakeStatus(chat_id=user_id, msg_id=client._new_id(), user_id=user_id)
+        task_data = {"link": link, "dest_chat_id": -100999, "dest_thread_id": None, "dest_title": "bench", "is_restricted": is_restricted}
+        await bot.start_task_final(client, context, task_data, 0, user_id)
+    await wait_idle()
+
+async def scenario_public(args):
+    client, acc = FakeClient(args.latency), FakeClient(args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds)
+    with LoopProbe() as probe:
+        start = time.perf_counter()
+        await run_batches(client, acc, [(1, f"https://t.me/{PUBLIC_CHAT}/1-{args.messages}")], is_restricted=False)
+        elapsed = time.perf_counter() - start
+    report("public", acc.delivered, elapsed, 0, probe)
+
+async def scenario_restricted(args):
+    size = int(args.file_size_mb * MB)
+    client = FakeClient(args.latency, args.bandwidth_mb * MB)
+    acc = FakeClient(args.latency, args.bandwidth_mb * MB, args.flood_rate, args.flood_seconds, file_size=size)
+    real_sessions, bot.MEDIA_SESSIONS = bot.MEDIA_SESSIONS, FakeMediaSessions()
+    try:
+        with LoopProbe() as probe:
+            start = time.perf_counter()
+            await run_batches(client, acc, [(2, f"https://t.me/c/{str(RESTRICTED_CHAT)[4:]}/1-{args.files}")], is_restricted=True)
+            elapsed = time.perf_counter() - start
+    finally:
+        bot.MEDIA_SESSIONS = real_sessions
+    moved = client.bytes_moved + acc.bytes_moved
+    uploads = client.uploads + acc.uploads
+    if uploads == 0:
+        raise SystemExit("restricted: no item was uploaded; the download/upload path failed (see the log above)")
+    report("restricted", uploads, elapsed, moved, probe)
+
+async def scenario_users(args):
+    client, acc = FakeClient(args.latency), FakeClient(args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds)
+    links = [(1000 + u, f"https://t.me/{PUBLIC_CHAT}/1-{args.per_user}") for u in range(args.users)]
+    with LoopProbe() as probe:
+        start = time.perf_counter()
+        await run_batches(client, acc, links, is_restricted=False)
+        elapsed = time.perf_counter() - start
+    report("users", acc.delivered, elapsed, 0, probe)
+
+async def scenario_db(args):
+    ops = 0
+    async def user_session(uid):
+        nonlocal ops
+        await bot.db.add_user(uid, f"user{uid}")
+        await bot.db.set_credentials(uid, "s" * bot.SESSION_STRING_SIZE, 1, "hash")
+        for _ in range(10):
+            await bot.db.get_session(uid)
+        await bot.db.save_task(f"t{uid}", uid, uid, {"link": "x"}, 0)
+        for i in range(5):
+            await bot.db.checkpoint_task(f"t{uid}", i)
+        await bot.db.delete_task(f"t{uid}")
+        ops += 19
+
+    with LoopProbe() as probe:
+        start = time.perf_counter()
+        await asyncio.gather(*(user_session(uid) for uid in range(args.users)))
+        elapsed = time.perf_counter() - start
+    report("database", ops, elapsed, 0, probe)
+
+async def scenario_split(args):
+    path = os.path.join(os.getcwd(), "split.bin")
+    size = 4 * 1024 * MB
+    with open(path, "wb") as f:
+        f.truncate(size)
+    with LoopProbe() as probe:
+        start = time.perf_counter()
+        rounds = 200
+        for _ in range(rounds):
+            file_size = await bot.fs_getsize(path)
+            parts = bot.make_file_slices(path, file_size, 1900 * MB)
+        buf = bytearray(MB)
+        read = 0
+        for part in parts:
+            for _ in range(64):
+                read += part.readinto(buf)
+            part.close()
+        elapsed = time.perf_counter() - start
+    os.remove(path)
+    report("split", rounds, elapsed, read, probe)
+
+async def scenario_upload(args):
+    """parallel_upload on one connection (the old single-session upload) vs --upload-connections."""
+    size = int(args.file_size_mb * MB)
+    path = os.path.join(os.getcwd(), "upload.bin")
+    with open(path, "wb") as f:
+        f.truncate(size)
+    real_sessions, bot.MEDIA_SESSIONS = bot.MEDIA_SESSIONS, FakeMediaSessions()
+    try:
+        for connections in sorted({1, args.upload_connections}):
+            client = FakeClient(args.latency, args.bandwidth_mb * MB, args.flood_rate, args.flood_seconds)
+            with LoopProbe() as probe:
+                start = time.perf_counter()
+                await bot.parallel_upload(client, path, size, "upload.bin", connections=connections)
+                elapsed = time.perf_counter() - start
+            report(f"upload x{connections}", 1, elapsed, client.bytes_moved, probe)
+    finally:
+        bot.MEDIA_SESSIONS = real_sessions
+        os.remove(path)
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+async def scenario_mongo(args):
+    """User lookups and the session count on a real mongod, before and after ensure_indexes()."""
+    if not args.mongo_uri:
+        print("mongo        skipped (needs a real mongod: --mongo-uri mongodb://...)")
+        return
+    db = bot.Database(args.mongo_uri, "rb_bench_index")
+    await db._client.drop_database("rb_bench_index")
+    try:
+        start = time.perf_counter()
+        batch = []
+        for uid in range(1, args.mongo_users + 1):
+            user = db.new_user(uid, f"user{uid}")
+            if uid % 10 == 0:  # A tenth of the users logged in
+                user.update(session="s" * bot.SESSION_STRING_SIZE, api_id=1, api_hash="hash")
+            batch.append(user)
+            if len(batch) == 10000:
+                await db.col.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            await db.col.insert_many(batch, ordered=False)
+        print(f"mongo        seeded {args.mongo_users} users in {time.perf_counter() - start:.1f}s")
+
+        rng = random.Random(args.seed)
+        for label in ("no index", "indexed"):
+            if label == "indexed":
+                await db.ensure_indexes()
+            # Distinct ids: every lookup misses the user cache and reaches mongod
+            ids = rng.sample(range(1, args.mongo_users + 1), args.mongo_lookups)
+            lookups = []
+            for uid in ids:
+                t = time.perf_counter()
+                await db.get_user_credentials(uid)
+                lookups.append(time.perf_counter() - t)
+            counts = []
+            for _ in range(5):
+                t = time.perf_counter()
+                await db.total_session_users_count()
+                counts.append(time.perf_counter() - t)
+            print(
+                f"mongo {label:<8} {len(lookups):>6} lookups  p50 {_percentile(lookups, 0.5) * 1000:>8.2f} ms  "
+                f"p99 {_percentile(lookups, 0.99) * 1000:>8.2f} ms  │  session count p50 {_percentile(counts, 0.5) * 1000:>8.2f} ms"
+            )
+    finally:
+        await db._client.drop_database("rb_bench_index")
+
+def random_link(rng):
+    """A random well-formed ParsedLink (property corpus for the parser)."""
+    kind = rng.choice(["public", "private", "bot", "invite"])
+    if kind == "invite":
+        return bot.ParsedLink("invite", invite=rng.choice(["+", "joinchat/"]) + "".join(rng.choices("abcXYZ019_-", k=rng.randint(8, 22))))
+    from_id = rng.randint(1, 10**7)
+    to_id = from_id + rng.choice([0, 0, rng.randint(1, 5000)])
+    if kind == "private":
+        chat, topic = int("-100" + str(rng.randint(10**9, 10**10))), rng.choice([None, rng.randint(1, 10**5)])
+    else:
+        # Usernames containing "c/"-like fragments used to break the old replace() chain
+        chat = rng.choice("abcdefgh") + "".join(rng.choices("abc_xyz0189", k=rng.randint(4, 30)))
+        topic = rng.choice([None, rng.randint(1, 10**5)]) if kind == "public" else None
+    return bot.ParsedLink(kind, chat, topic, from_id, to_id)
+
+async def scenario_links(args):
+    rng = random.Random(args.seed)
+    corpus = [random_link(rng) for _ in range(args.links)]
+    texts = []
+    for link in corpus:
+        url = link.url()
+        # Same link as users paste it: "a - b" spacing, http/no scheme, surrounding text
+        if link.to_id != link.from_id and rng.random() < 0.5:
+            url = url.replace(f"-{link.to_id}", f" - {link.to_id}")
+        url = rng.choice(["", "http://", "https://www."]) + url.split("://", 1)[1] if rng.random() < 0.3 else url
+        texts.append(rng.choice(["", "save this: ", "👉 "]) + url + rng.choice(["", " thanks", "\n"]))
+
+    mismatches = [(t, c, bot.parse_link(t)) for t, c in zip(texts, corpus) if bot.parse_link(t) != c]
+    for text, expected, got in mismatches[:10]:
+        print(f"  MISMATCH {text!r}: expected {expected!r}, got {got!r}")
+    multi = "\n".join(texts[:100])
+    assert bot.parse_links(multi) == corpus[:100], "multi-link message parsed differently"
+
+    with LoopProbe() as probe:
+        start = time.perf_counter()
+        for text in texts:
+            bot.parse_links(text)
+        elapsed = time.perf_counter() - start
+    report("links", len(texts), elapsed, 0, probe)
+    print(f"  {len(corpus) - len(mismatches)}/{len(corpus)} links round-trip, {elapsed / len(texts) * 1e6:.2f} µs/link")
+
+SCENARIOS = {
+    "public": scenario_public,
+    "restricted": scenario_restricted,
+    "users": scenario_users,
+    "db": scenario_db,
+    "split": scenario_split,
+    "upload": scenario_upload,
+    "links": scenario_links,
+    "mongo": scenario_mongo,
+}
+
+async def main(args):
+    random.seed(args.seed)
+    install_fake_db(args.mongo_rtt)
+    if not args.paced:
+        # Measure the bot itself, not Telegram's limits
+        bot.RATE_LIMITER.DEFAULT_RATES = {op: (1e6, 1e6, 1e6) for op in bot.RATE_LIMITER.DEFAULT_RATES}
+        bot.RATE_LIMITER.burst = 1e6
+    # Status edits are not what we measure
+    bot.PROGRESS_HUB.interval = 3600
+    if args.pipeline_depth:
+        bot.PIPELINE_DEPTH = args.pipeline_depth
+    if args.no_stream:
+        bot.STREAM_MODE = False
+    bot.DOWNLOAD_CONNECTIONS = bot.UPLOAD_CONNECTIONS = args.connections
+
+    for name in args.scenario or list(SCENARIOS):
+        await SCENARIOS[name](args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for restrict_bot")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Telegram call")
+    parser.add_argument("--bandwidth-mb", type=float, default=1000, help="media MB/s per transfer")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of calls raising FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--mongo-rtt", type=float, default=0.001, help="seconds per Mongo round trip")
+    parser.add_argument("--mongo-uri", default=os.environ.get("BENCH_MONGO_URI"), help="real mongod for the mongo scenario (scratch db rb_bench_index)")
+    parser.add_argument("--mongo-users", type=int, default=1000000, help="users seeded for the mongo scenario")
+    parser.add_argument("--mongo-lookups", type=int, default=2000, help="random user lookups per index state")
+    parser.add_argument("--messages", type=int, default=1000, help="public range size")
+    parser.add_argument("--files", type=int, default=50, help="restricted files")
+    parser.add_argument("--file-size-mb", type=float, default=2048)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--per-user", type=int, default=20, help="messages per user batch")
+    parser.add_argument("--links", type=int, default=100000, help="link parser corpus size")
+    parser.add_argument("--paced", action="store_true", help="keep the adaptive rate limiter's real rates")
+    parser.add_argument("--upload-connections", type=int, default=4, help="media sessions for the upload scenario")
+    parser.add_argument("--pipeline-depth", type=int, default=0, help="messages in flight per batch (1 = sequential)")
+    parser.add_argument("--connections", type=int, default=1, help="media sessions per transfer direction in the restricted scenario")
+    parser.add_argument("--no-stream", action="store_true", help="restricted files take the disk path instead of streaming")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rb-bench-")
+    os.chdir(workdir)  # downloads/ lands here, not in the repo
+    try:
+        asyncio.run(main(args))
+    finally:
+        import shutil
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
+import io
+import sys
+import threading
+import traceback
+import cProfile
+import pstats
 import psutil
 import time
 import asyncio
@@ -10,9 +16,11 @@ import gc
 import datetime
 import uuid
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from contextlib import asynccontextmanager
 import motor.motor_asyncio
-from pyrogram import Client, filters, enums, idle
+from pymongo import DeleteOne
+from pyrogram import Client, filters, enums, idle, raw, utils
 from pyrogram.errors import (
     FloodWait, UserIsBlocked, InputUserDeactivated, UserAlreadyParticipant,
     InviteHashExpired, UsernameNotOccupied, FileReferenceExpired, UserNotParticipant,
@@ -20,6 +28,8 @@ from pyrogram.errors import (
     SessionPasswordNeeded, PasswordHashInvalid, PeerIdInvalid, AuthKeyUnregistered, UserDeactivated
 )
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from pyrogram.session import Session, Auth
+from pyrogram.file_id import FileId
 from concurrent.futures import ThreadPoolExecutor
 
 try:
@@ -43,11 +53,26 @@ STRING_SESSION = os.environ.get("STRING_SESSION", None)
 # Usage: "-100xxxx" for channel, or "-100xxxx/5" for Group Topic
 LOG_CHANNEL = os.environ.get("LOG_CHANNEL", "") 
 
-# Queue System
-TASK_QUEUE = defaultdict(list) # Stores pending tasks: user_id -> [task_data, ...]
-
 # Create a thread pool for blocking tasks
 io_executor = ThreadPoolExecutor(max_workers=4)
+# Separate small pool for metadata work (mkdir/stat/delete) so it never queues behind big reads/writes
+fs_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("FS_WORKERS", "2")), thread_name_prefix="fs")
+
+# Streaming Mode: pipe restricted media download -> upload through memory (no file on disk)
+STREAM_MODE = os.environ.get("STREAM_MODE", "True").lower() == "true"
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", "16")) # x 1 MB chunks held in RAM per transfer
+
+# Parallel Upload/Download: number of media-DC connections used for one large transfer
+UPLOAD_CONNECTIONS = int(os.environ.get("UPLOAD_CONNECTIONS", "4"))
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+
+# Media Dedup Cache: resend files the bot already uploaded (keyed by file_unique_id)
+MEDIA_CACHE = os.environ.get("MEDIA_CACHE", "True").lower() == "true"
+MEDIA_CACHE_TTL = int(os.environ.get("MEDIA_CACHE_TTL", str(30 * 86400)))  # seconds since last use
+
+# Broadcast: global send rate (Bot API allows ~30 msgs/s) and concurrent senders
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "20"))
 
 LOGIN_SYSTEM = os.environ.get("LOGIN_SYSTEM", "True").lower() == "true"
 ERROR_MESSAGE = os.environ.get("ERROR_MESSAGE", "True").lower() == "true"
@@ -91,11 +116,225 @@ HELP_TXT = """**📚 BOT'S HELP MENU**
 # --- DATABASE ---
 # ==============================================================================
 
+class AsyncTTLCache:
+    """
+    Small in-process cache with TTL + LRU eviction. Concurrent misses for the
+    same key share a single loader call instead of each hitting the database.
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}  # key -> Future
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return self._MISSING
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return self._MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        # A load already in flight may carry pre-write data; don't let it be cached
+        self._inflight.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is not self._MISSING:
+            return value
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await loader()
+        except BaseException as e:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved so waiter-less failures aren't logged
+            raise
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+            self.set(key, value)
+        fut.set_result(value)
+        return value
+
+# ==============================================================================
+# --- METRICS (Prometheus text format, served on /metrics) ---
+# ==============================================================================
+
+class _Metric:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _fmt(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs: return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{self._fmt(key)} {value}"
+
+class Histogram(_Metric):
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound: series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels):
+        """Times a block; usable with both `with` and `async with`."""
+        return _HistogramTimer(self, labels)
+
+    def samples(self):
+        for key, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{self._fmt(key, [('le', bound)])} {count}"
+            yield f"{self.name}_bucket{self._fmt(key, [('le', '+Inf')])} {series[-1]}"
+            yield f"{self.name}_sum{self._fmt(key)} {series[-2]}"
+            yield f"{self.name}_count{self._fmt(key)} {series[-1]}"
+
+class _HistogramTimer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+class Gauge(_Metric):
+    """Read at scrape time from a callback, so nothing has to keep it updated."""
+    type = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        super().__init__(name, help_text)
+        self.fn = fn
+
+    def samples(self):
+        try: value = self.fn()
+        except Exception: return
+        yield f"{self.name} {value}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), **kwargs):
+        return self._register(Histogram(name, help_text, labelnames, **kwargs))
+
+    def gauge(self, name, help_text, fn):
+        return self._register(Gauge(name, help_text, fn))
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.type}")
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+M_MESSAGES = METRICS.counter("rb_messages_total", "Messages processed by batch tasks", ("result",))
+M_BYTES = METRICS.counter("rb_bytes_total", "Media bytes transferred", ("direction",))
+M_STAGE = METRICS.histogram("rb_stage_seconds", "Latency per pipeline stage", ("stage",))
+M_FLOODWAIT = METRICS.counter("rb_floodwait_seconds_total", "FloodWait seconds imposed by Telegram", ("method",))
+M_LOOP_LAG = METRICS.histogram("rb_loop_lag_seconds", "Event-loop scheduling lag", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+M_MONGO = METRICS.histogram("rb_mongo_seconds", "MongoDB round-trip time", ("op",), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+# Gauges are read at scrape time, so they may name objects defined further down
+METRICS.gauge("rb_tasks_running", "Batch tasks currently running", lambda: SCHEDULER.running())
+METRICS.gauge("rb_tasks_queued", "Batch tasks waiting in the scheduler", lambda: SCHEDULER.queued())
+for _pool_name in ("download", "upload", "forward"):
+    METRICS.gauge(f"rb_pool_{_pool_name}_active", f"Busy {_pool_name} slots", lambda n=_pool_name: SCHEDULER.pools[n].active)
+    METRICS.gauge(f"rb_pool_{_pool_name}_waiting", f"Transfers waiting for a {_pool_name} slot", lambda n=_pool_name: len(SCHEDULER.pools[n]._waiters))
+METRICS.gauge("rb_user_clients_active", "Pooled user clients in use", lambda: USER_CLIENTS.active_count())
+METRICS.gauge("rb_user_clients_open", "Pooled user clients connected", lambda: len(USER_CLIENTS))
+METRICS.gauge("rb_disk_free_bytes", "Free disk space for downloads", lambda: psutil.disk_usage('.').free)
+METRICS.gauge("rb_media_cache_hit_ratio", "Dedup cache hit ratio", lambda: media_cache_hit_rate() / 100.0)
+
 class Database:
+    _CREDENTIAL_FIELDS = {'_id': 0, 'id': 1, 'session': 1, 'api_id': 1, 'api_hash': 1}
+
     def __init__(self, uri, database_name):
         self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
         self.db = self._client[database_name]
         self.col = self.db.users
+        self.tasks = self.db.tasks
+        self.media = self.db.media
+        self.broadcasts = self.db.broadcasts
+        self._media_cache = AsyncTTLCache(maxsize=int(os.environ.get("MEDIA_CACHE_SIZE", "5000")), ttl=600)
+        self._user_cache = AsyncTTLCache(
+            maxsize=int(os.environ.get("USER_CACHE_SIZE", "10000")),
+            ttl=int(os.environ.get("USER_CACHE_TTL", "300"))
+        )
+
+    async def _timed(self, op, awaitable):
+        start = time.perf_counter()
+        try: return await awaitable
+        finally: M_MONGO.observe(time.perf_counter() - start, op=op)
 
     def new_user(self, id, name):
         return dict(
@@ -106,53 +345,188 @@ class Database:
             api_hash = None,
         )
 
+    async def ensure_indexes(self):
+        """Creates the lookup indexes once at startup (no-op if they already exist)"""
+        try:
+            await self.col.create_index("id", unique=True, name="id_unique")
+        except Exception as e:
+            # Legacy duplicates from the old check-then-insert add_user block the unique index
+            print(f"⚠️ Unique index on users.id failed ({e}); using a plain index.")
+            try: await self.col.create_index("id", name="id_lookup")
+            except Exception as e2: print(f"⚠️ Index Error: {e2}")
+        try:
+            await self.col.create_index(
+                "session", name="session_present",
+                partialFilterExpression={"session": {"$type": "string"}}
+            )
+            await self.tasks.create_index("created", name="task_created")
+            # Unused entries age out on their own: least recently used go first
+            await self.media.create_index("last_used", name="media_lru", expireAfterSeconds=MEDIA_CACHE_TTL)
+        except Exception as e:
+            print(f"⚠️ Index Error: {e}")
+
     async def add_user(self, id, name):
-        user = self.new_user(id, name)
-        if not await self.is_user_exist(id):
-            await self.col.insert_one(user)
+        """Atomically inserts the user if missing. Returns True when a new user was created."""
+        user = self.new_user(int(id), name)
+        result = await self._timed("add_user", self.col.update_one({'id': int(id)}, {'$setOnInsert': user}, upsert=True))
+        if result.upserted_id is not None:
+            self._user_cache.invalidate(int(id))
+            return True
+        return False
 
     async def is_user_exist(self, id):
-        user = await self.col.find_one({'id':int(id)})
+        user = await self.get_user_credentials(id)
         return bool(user)
 
+    async def get_user_credentials(self, id):
+        """Returns {'id', 'session', 'api_id', 'api_hash'} (or None) with one cached, projected query."""
+        id = int(id)
+        return await self._user_cache.get_or_load(
+            id, lambda: self._timed("get_user", self.col.find_one({'id': id}, self._CREDENTIAL_FIELDS))
+        )
+
     async def total_users_count(self):
-        count = await self.col.count_documents({})
+        count = await self._timed("count_users", self.col.count_documents({}))
         return count
 
     async def get_all_users(self):
         cursor = self.col.find({})
         return cursor
 
+    async def get_user_ids_page(self, after_id=None, limit=500):
+        """Next `limit` user ids in ascending order after `after_id` (walks the id index)."""
+        query = {'id': {'$gt': after_id}} if after_id is not None else {}
+        cursor = self.col.find(query, {'_id': 0, 'id': 1}).sort('id', 1).limit(limit)
+        docs = await self._timed("user_ids_page", cursor.to_list(length=limit))
+        return [doc['id'] for doc in docs]
+
+    async def delete_users_bulk(self, ids):
+        if not ids: return
+        await self._timed("delete_users", self.col.bulk_write([DeleteOne({'id': int(i)}) for i in ids], ordered=False))
+        for i in ids:
+            self._user_cache.invalidate(int(i))
+
     async def delete_user(self, user_id):
-        await self.col.delete_many({'id': int(user_id)})
+        await self._timed("delete_user", self.col.delete_many({'id': int(user_id)}))
+        self._user_cache.invalidate(int(user_id))
 
     async def set_session(self, id, session):
-        await self.col.update_one({'id': int(id)}, {'$set': {'session': session}})
+        await self._timed("set_session", self.col.update_one({'id': int(id)}, {'$set': {'session': session}}))
+        self._user_cache.invalidate(int(id))
 
     async def get_session(self, id):
-        user = await self.col.find_one({'id': int(id)})
+        user = await self.get_user_credentials(id)
         if user:
             return user.get('session')
         return None
 
     async def set_api_id(self, id, api_id):
-        await self.col.update_one({'id': int(id)}, {'$set': {'api_id': api_id}})
+        await self._timed("set_api_id", self.col.update_one({'id': int(id)}, {'$set': {'api_id': api_id}}))
+        self._user_cache.invalidate(int(id))
 
     async def get_api_id(self, id):
-        user = await self.col.find_one({'id': int(id)})
-        return user.get('api_id')
+        user = await self.get_user_credentials(id)
+        return user.get('api_id') if user else None
 
     async def set_api_hash(self, id, api_hash):
-        await self.col.update_one({'id': int(id)}, {'$set': {'api_hash': api_hash}})
+        await self._timed("set_api_hash", self.col.update_one({'id': int(id)}, {'$set': {'api_hash': api_hash}}))
+        self._user_cache.invalidate(int(id))
 
     async def get_api_hash(self, id):
-        user = await self.col.find_one({'id': int(id)})
-        return user.get('api_hash')
+        user = await self.get_user_credentials(id)
+        return user.get('api_hash') if user else None
+
+    async def set_credentials(self, id, session, api_id, api_hash):
+        await self._timed("set_credentials", self.col.update_one(
+            {'id': int(id)},
+            {'$set': {'session': session, 'api_id': api_id, 'api_hash': api_hash}}
+        ))
+        self._user_cache.invalidate(int(id))
+
+    async def clear_credentials(self, id):
+        await self.set_credentials(id, None, None, None)
 
     async def total_session_users_count(self):
-        count = await self.col.count_documents({"session": {"$ne": None}})
+        # Matches the partial "session_present" index, so this is an index-only count
+        count = await self._timed("count_sessions", self.col.count_documents({"session": {"$type": "string"}}))
         return count
 
+    # --- Task Journal (resumable batches) ---
+
+    async def save_task(self, task_uuid, user_id, origin_chat_id, task_data, delay):
+        await self._timed("save_task", self.tasks.update_one(
+            {'_id': task_uuid},
+            {'$set': {
+                'user_id': int(user_id),
+                'origin_chat_id': origin_chat_id,
+                'link': task_data.get('link'),
+                'dest_chat_id': task_data.get('dest_chat_id'),
+                'dest_thread_id': task_data.get('dest_thread_id'),
+                'dest_title': task_data.get('dest_title'),
+                'is_restricted': task_data.get('is_restricted', False),
+                'delay': delay,
+                'status': 'queued',
+                'last_msg_id': None,
+                'created': time.time(),
+            }},
+            upsert=True
+        ))
+
+    async def set_task_status(self, task_uuid, status):
+        await self._timed("task_status", self.tasks.update_one({'_id': task_uuid}, {'$set': {'status': status}}))
+
+    async def checkpoint_task(self, task_uuid, last_msg_id):
+        await self._timed("checkpoint", self.tasks.update_one({'_id': task_uuid}, {'$set': {'last_msg_id': last_msg_id}}))
+
+    async def delete_task(self, task_uuid):
+        await self._timed("delete_task", self.tasks.delete_one({'_id': task_uuid}))
+
+    async def get_unfinished_tasks(self):
+        return self.tasks.find({}).sort('created', 1)
+
+    # --- Broadcast Journal (resumable broadcasts) ---
+
+    async def save_broadcast(self, job):
+        fields = {k: v for k, v in job.items() if k != '_id'}
+        await self._timed("save_broadcast", self.broadcasts.update_one({'_id': job['_id']}, {'$set': fields}, upsert=True))
+
+    async def checkpoint_broadcast(self, job_id, last_user_id, counts):
+        await self._timed("broadcast_checkpoint", self.broadcasts.update_one(
+            {'_id': job_id}, {'$set': {'last_user_id': last_user_id, 'counts': counts}}
+        ))
+
+    async def delete_broadcast(self, job_id):
+        await self._timed("delete_broadcast", self.broadcasts.delete_one({'_id': job_id}))
+
+    async def get_active_broadcast(self):
+        return await self._timed("get_broadcast", self.broadcasts.find_one({}))
+
+    # --- Media Dedup Cache (source file_unique_id -> bot's file_id) ---
+
+    async def get_cached_media(self, unique_id):
+        return await self._media_cache.get_or_load(
+            unique_id, lambda: self._timed("get_media", self.media.find_one({'_id': unique_id}, {'file_id': 1, 'msg_type': 1}))
+        )
+
+    async def save_cached_media(self, unique_id, file_id, msg_type):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await self._timed("save_media", self.media.update_one(
+            {'_id': unique_id},
+            {'$set': {'file_id': file_id, 'msg_type': msg_type, 'last_used': now}, '$setOnInsert': {'created': now, 'hits': 0}},
+            upsert=True
+        ))
+        self._media_cache.set(unique_id, {'_id': unique_id, 'file_id': file_id, 'msg_type': msg_type})
+
+    async def touch_cached_media(self, unique_id):
+        await self._timed("touch_media", self.media.update_one(
+            {'_id': unique_id},
+            {'$set': {'last_used': datetime.datetime.now(datetime.timezone.utc)}, '$inc': {'hits': 1}}
+        ))
+
+    async def drop_cached_media(self, unique_id):
+        await self._timed("drop_media", self.media.delete_one({'_id': unique_id}))
+        self._media_cache.invalidate(unique_id)
+
 db = Database(DB_URI, DB_NAME)
 
 # ==============================================================================
@@ -174,16 +548,24 @@ ACTIVE_PROCESSES = defaultdict(dict)  # user_id -> { task_uuid: info_dict, ... }
 CANCEL_FLAGS = {}  # task_uuid -> True when cancelled
 
 batch_temp = type("BT", (), {})()
-batch_temp.ACTIVE_TASKS = defaultdict(int)
 batch_temp.IS_BATCH = defaultdict(bool)
 
-UPLOAD_SEMAPHORE = asyncio.Semaphore(3)
-USER_UPLOAD_LOCKS = defaultdict(asyncio.Lock)
 PENDING_TASKS = {}
-PROGRESS = {}
 SESSION_STRING_SIZE = 351
 
+# Task Journal: persist batch progress to Mongo every N messages so restarts resume
+TASK_CHECKPOINT_EVERY = int(os.environ.get("TASK_CHECKPOINT_EVERY", "10"))
+
+# Scheduler limits (fair-shared across users, ADMINS served first)
 MAX_CONCURRENT_TASKS_PER_USER = int(os.environ.get("MAX_TASKS_PER_USER", "3"))
+MAX_ACTIVE_TASKS = int(os.environ.get("MAX_ACTIVE_TASKS", "30"))
+DOWNLOAD_SLOTS = int(os.environ.get("DOWNLOAD_SLOTS", "6"))
+UPLOAD_SLOTS = int(os.environ.get("UPLOAD_SLOTS", "3"))
+FORWARD_SLOTS = int(os.environ.get("FORWARD_SLOTS", "10"))
+
+# User Client Pool (warm MTProto connections per logged-in user)
+USER_CLIENT_POOL_SIZE = int(os.environ.get("USER_CLIENT_POOL_SIZE", "50"))
+USER_CLIENT_IDLE_TTL = int(os.environ.get("USER_CLIENT_IDLE_TTL", "600"))
 
 GlobalUserSession = None
 if STRING_SESSION and not LOGIN_SYSTEM:
@@ -193,6 +575,426 @@ if STRING_SESSION and not LOGIN_SYSTEM:
     except Exception as e:
         print(f"Failed to start Global User Session: {e}")
 
+# ==============================================================================
+# --- USER CLIENT POOL ---
+# ==============================================================================
+
+class UserClientPool:
+    """
+    Keeps one connected user Client per user_id so batches, link checks and
+    logout reuse the same MTProto connection instead of handshaking each time.
+    Clients are reference-counted, evicted LRU/TTL when idle, and capped at
+    max_clients open connections. A client replaced while in use (re-login,
+    /logout, dead connection) is detached and closed on its last release.
+    """
+    def __init__(self, max_clients=50, idle_ttl=600):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()  # user_id -> current {user_id, client, session, refs, last_used}
+        self._open = {}  # id(client) -> entry, current and detached
+        self._user_locks = defaultdict(asyncio.Lock)
+        self._slot_freed = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._open)
+
+    def active_count(self):
+        return sum(1 for e in self._open.values() if e["refs"] > 0)
+
+    async def acquire(self, user_id):
+        """Returns a connected Client for the user. Pair every call with release(user_id, client)."""
+        user_id = int(user_id)
+        async with self._user_locks[user_id]:
+            creds = await db.get_user_credentials(user_id)
+            session = creds.get("session") if creds else None
+            if not session:
+                raise ValueError("Not logged in")
+
+            entry = self._entries.get(user_id)
+            if entry and (entry["session"] != session or not entry["client"].is_connected):
+                await self._retire(entry)
+                entry = None
+
+            if entry is None:
+                await self._reserve_slot()
+                api_id = creds.get("api_id")
+                api_hash = creds.get("api_hash")
+                client = Client(
+                    ":memory:",
+                    session_string=session,
+                    api_id=int(api_id) if api_id else API_ID,
+                    api_hash=api_hash if api_hash else API_HASH,
+                    no_updates=True
+                )
+                await client.connect()
+                entry = {"user_id": user_id, "client": client, "session": session, "refs": 0, "last_used": time.time()}
+                self._entries[user_id] = entry
+                self._open[id(client)] = entry
+
+            entry["refs"] += 1
+            entry["last_used"] = time.time()
+            self._entries.move_to_end(user_id)
+            return entry["client"]
+
+    async def release(self, user_id, client):
+        """Returns `client` (from acquire) to the pool; a detached client is closed on its last release."""
+        entry = self._open.get(id(client))
+        if not entry:
+            return
+        entry["refs"] = max(0, entry["refs"] - 1)
+        entry["last_used"] = time.time()
+        if entry["refs"] == 0 and self._entries.get(entry["user_id"]) is not entry:
+            await self._close(entry)
+        async with self._slot_freed:
+            self._slot_freed.notify_all()
+
+    async def invalidate(self, user_id, client=None):
+        """
+        Drops the user's client (on /logout or AuthKeyUnregistered), or only
+        `client` if given, so a newer login is left alone. In-use clients are
+        detached and close on their last release.
+        """
+        entry = self._entries.get(int(user_id)) if client is None else self._open.get(id(client))
+        if entry:
+            await self._retire(entry)
+
+    async def evict_idle(self):
+        now = time.time()
+        for entry in list(self._entries.values()):
+            if entry["refs"] == 0 and (now - entry["last_used"]) > self.idle_ttl:
+                await self._retire(entry)
+
+    async def reaper(self):
+        """Background loop that closes clients idle for longer than idle_ttl"""
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                print(f"Client Pool Reaper Error: {e}")
+
+    async def _reserve_slot(self):
+        # Evict least recently used idle clients first; wait if every slot is in use.
+        while len(self._open) >= self.max_clients:
+            idle = next((e for e in self._entries.values() if e["refs"] == 0), None)
+            if idle is not None:
+                await self._retire(idle)
+                continue
+            async with self._slot_freed:
+                await self._slot_freed.wait()
+
+    async def _retire(self, entry):
+        # No longer handed out; closed now if unused, else by the last release()
+        if self._entries.get(entry["user_id"]) is entry:
+            del self._entries[entry["user_id"]]
+        if entry["refs"] == 0:
+            await self._close(entry)
+
+    async def _close(self, entry):
+        if self._open.pop(id(entry["client"]), None) is None:
+            return
+        await MEDIA_SESSIONS.close_client(entry["client"])
+        try:
+            if entry["client"].is_connected:
+                await entry["client"].disconnect()
+        except: pass
+        async with self._slot_freed:
+            self._slot_freed.notify_all()
+
+USER_CLIENTS = UserClientPool(max_clients=USER_CLIENT_POOL_SIZE, idle_ttl=USER_CLIENT_IDLE_TTL)
+
+# ==============================================================================
+# --- SCHEDULER ---
+# ==============================================================================
+
+class FairQueue:
+    """
+    Round-robin queue of per-user FIFOs (deficit round robin with a unit
+    quantum). ADMINS have their own FIFO which is always served first.
+    Users at their per-user cap are parked off the ring, so put/pop are O(1).
+    """
+    def __init__(self, per_user_limit=0):
+        self.per_user_limit = per_user_limit  # 0 = unlimited
+        self.in_use = defaultdict(int)  # user_id -> granted items
+        self._admin = deque()
+        self._ring = OrderedDict()  # user_id -> deque, in round-robin order
+        self._parked = {}  # user_id -> deque, users at their cap with waiting items
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _capped(self, user_id):
+        return self.per_user_limit and user_id not in ADMINS and self.in_use[user_id] >= self.per_user_limit
+
+    def put(self, user_id, item):
+        self._size += 1
+        if user_id in ADMINS:
+            self._admin.append((user_id, item))
+            return
+        q = self._ring.get(user_id) or self._parked.get(user_id)
+        if q is None:
+            q = deque()
+            if self._capped(user_id): self._parked[user_id] = q
+            else: self._ring[user_id] = q
+        q.append(item)
+
+    def pop(self):
+        """Returns (user_id, item) for the next eligible user, or None."""
+        if self._admin:
+            self._size -= 1
+            return self._admin.popleft()
+        while self._ring:
+            user_id, q = self._ring.popitem(last=False)
+            item = q.popleft()
+            self._size -= 1
+            if q:
+                # Rotate to the back, or park if this grant reaches the user's cap
+                if self.per_user_limit and self.in_use[user_id] + 1 >= self.per_user_limit: self._parked[user_id] = q
+                else: self._ring[user_id] = q
+            return user_id, item
+        return None
+
+    def granted(self, user_id):
+        self.in_use[user_id] += 1
+
+    def released(self, user_id):
+        self.in_use[user_id] -= 1
+        if self.in_use[user_id] <= 0:
+            del self.in_use[user_id]
+        q = self._parked.pop(user_id, None)
+        if q:
+            self._ring[user_id] = q
+
+    def position(self, user_id, item):
+        """1-based position of item in its user's FIFO, or 0 if it is no longer queued."""
+        if user_id in ADMINS:
+            entries = [i for _, i in self._admin]
+        else:
+            entries = self._ring.get(user_id) or self._parked.get(user_id) or ()
+        for pos, queued in enumerate(entries, start=1):
+            if queued is item: return pos
+        return 0
+
+    def count(self, user_id):
+        if user_id in ADMINS:
+            return sum(1 for uid, _ in self._admin if uid == user_id)
+        return len(self._ring.get(user_id) or self._parked.get(user_id) or ())
+
+    def drain(self, user_id):
+        """Removes and returns every queued item of user_id, in FIFO order."""
+        items = []
+        for container in (self._ring, self._parked):
+            q = container.pop(user_id, None)
+            if q: items.extend(q)
+        if user_id in ADMINS:
+            items.extend(item for uid, item in self._admin if uid == user_id)
+            self._admin = deque(entry for entry in self._admin if entry[0] != user_id)
+        self._size -= len(items)
+        return items
+
+    def discard(self, user_id, item):
+        """Removes a waiter that gave up (cancelled). O(n) for that user's FIFO only."""
+        for container in (self._ring, self._parked):
+            q = container.get(user_id)
+            if q and item in q:
+                q.remove(item)
+                self._size -= 1
+                if not q: del container[user_id]
+                return
+        if (user_id, item) in self._admin:
+            self._admin.remove((user_id, item))
+            self._size -= 1
+
+class ResourcePool:
+    """A fair, per-user capped semaphore for one resource (download/upload/forward)."""
+    def __init__(self, name, limit, per_user_limit=0):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._waiters = FairQueue(per_user_limit)
+
+    async def acquire(self, user_id):
+        if self.active < self.limit and not len(self._waiters) and not self._waiters._capped(user_id):
+            self._grant(user_id)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.put(user_id, fut)
+        self._wake()  # Free slots go to eligible waiters even while capped users are parked
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(user_id)  # Granted just as we were cancelled; hand it on
+            else:
+                self._waiters.discard(user_id, fut)
+            raise
+
+    def release(self, user_id):
+        self.active -= 1
+        self._waiters.released(user_id)
+        self._wake()
+
+    def _grant(self, user_id):
+        self.active += 1
+        self._waiters.granted(user_id)
+
+    def _wake(self):
+        while self.active < self.limit:
+            nxt = self._waiters.pop()
+            if nxt is None: return
+            user_id, fut = nxt
+            if fut.done(): continue
+            self._grant(user_id)
+            fut.set_result(None)
+
+class TaskScheduler:
+    """
+    Admits batch tasks fairly across users and owns the download/upload/forward
+    resource pools. Replaces the per-user TASK_QUEUE lists, ACTIVE_TASKS
+    counters and the global upload semaphore.
+    """
+    def __init__(self, max_active, per_user, pool_limits):
+        self.max_active = max_active
+        self.active = defaultdict(int)  # user_id -> running tasks
+        self._queue = FairQueue(per_user)
+        self.pools = {name: ResourcePool(name, limit, per_user_limit) for name, (limit, per_user_limit) in pool_limits.items()}
+
+    def running(self, user_id=None):
+        if user_id is None:
+            return sum(self.active.values())
+        return self.active.get(user_id, 0)
+
+    def queued(self, user_id=None):
+        if user_id is None:
+            return len(self._queue)
+        return self._queue.count(user_id)
+
+    def submit(self, user_id, launcher, on_drop=None):
+        """
+        Queues `launcher` (a coroutine function that starts the task) and
+        dispatches whatever is eligible. `on_drop` (a coroutine function) is
+        returned by cancel_queued() if the task is dropped before it starts.
+        Returns 0 if it started right away, otherwise the user's queue position.
+        """
+        entry = (launcher, on_drop)
+        self._queue.put(user_id, entry)
+        self._dispatch()
+        return self._queue.position(user_id, entry)
+
+    def cancel_queued(self, user_id):
+        """Drops every task the user still has waiting; returns their on_drop callbacks to run."""
+        return [on_drop for _, on_drop in self._queue.drain(user_id) if on_drop]
+
+    def finish(self, user_id):
+        self.active[user_id] -= 1
+        if self.active[user_id] <= 0:
+            del self.active[user_id]
+        self._queue.released(user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running() < self.max_active:
+            nxt = self._queue.pop()
+            if nxt is None: return
+            user_id, (launcher, _) = nxt
+            self.active[user_id] += 1
+            self._queue.granted(user_id)
+            asyncio.create_task(launcher())
+
+    @asynccontextmanager
+    async def slot(self, pool_name, user_id):
+        pool = self.pools[pool_name]
+        await pool.acquire(user_id)
+        try:
+            yield
+        finally:
+            pool.release(user_id)
+
+    def snapshot(self):
+        return {
+            "running": self.running(),
+            "queued": self.queued(),
+            "pools": {name: (p.active, p.limit, len(p._waiters)) for name, p in self.pools.items()},
+        }
+
+class AdaptiveRateLimiter:
+    """
+    Token buckets keyed by (account, destination chat, operation), shared by
+    every task using the same session. Rates are learned AIMD-style: each
+    success adds `increase` msgs/s, each FloodWait halves the rate and blocks
+    the bucket for the wait the server asked for.
+    """
+    # operation -> (initial, min, max) msgs per second
+    DEFAULT_RATES = {
+        "copy": (1.0, 0.05, 10.0), "send": (1.0, 0.05, 10.0), "upload": (0.5, 0.02, 4.0), "forward": (0.5, 0.02, 2.0),
+        "broadcast": (BROADCAST_RATE, 1.0, 30.0),
+    }
+
+    def __init__(self, increase=0.05, decrease=0.5, burst=3):
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self._buckets = {}
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            initial, low, high = self.DEFAULT_RATES.get(key[2], (1.0, 0.05, 10.0))
+            bucket = self._buckets[key] = {
+                "rate": initial, "min": low, "max": high, "tokens": 1.0,
+                "last": time.monotonic(), "blocked_until": 0.0, "lock": asyncio.Lock()
+            }
+        return bucket
+
+    async def acquire(self, key):
+        bucket = self._bucket(key)
+        async with bucket["lock"]:  # Waiters on the same bucket are served in order
+            while True:
+                now = time.monotonic()
+                if now < bucket["blocked_until"]:
+                    await asyncio.sleep(bucket["blocked_until"] - now)
+                    continue
+                bucket["tokens"] = min(self.burst, bucket["tokens"] + (now - bucket["last"]) * bucket["rate"])
+                bucket["last"] = now
+                if bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return
+                await asyncio.sleep((1 - bucket["tokens"]) / bucket["rate"])
+
+    def success(self, key):
+        bucket = self._bucket(key)
+        bucket["rate"] = min(bucket["max"], bucket["rate"] + self.increase)
+
+    def flood(self, key, seconds):
+        M_FLOODWAIT.inc(seconds, method=key[2])
+        bucket = self._bucket(key)
+        bucket["rate"] = max(bucket["min"], bucket["rate"] * self.decrease)
+        bucket["tokens"] = 0.0
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.monotonic() + seconds)
+
+    def rate(self, key):
+        return self._bucket(key)["rate"]
+
+def rate_key(account, dest_chat_id, operation):
+    return (account, dest_chat_id, operation)
+
+def user_account(user_id):
+    # Without LOGIN_SYSTEM every task shares the same global session
+    return f"user:{user_id}" if LOGIN_SYSTEM else "global"
+
+RATE_LIMITER = AdaptiveRateLimiter()
+
+SCHEDULER = TaskScheduler(
+    max_active=MAX_ACTIVE_TASKS,
+    per_user=MAX_CONCURRENT_TASKS_PER_USER,
+    pool_limits={
+        "download": (DOWNLOAD_SLOTS, 0),
+        "upload": (UPLOAD_SLOTS, 1),  # One upload per user at a time
+        "forward": (FORWARD_SLOTS, 0),
+    }
+)
+
 # ==============================================================================
 # --- HELPERS ---
 # ==============================================================================
@@ -242,41 +1044,147 @@ def sanitize_filename(filename: str) -> str:
         ext = ".dat"
     return f"{name}{ext}"
 
+# ==============================================================================
+# --- LINK PARSER ---
+# ==============================================================================
+
+LINK_RE = re.compile(
+    r"(?:https?://)?(?:www\.)?(?:t|telegram)\.me/"
+    r"(?:"
+    r"(?P<invite>\+[\w-]+|joinchat/[\w-]+)"                                  # invite
+    r"|c/(?P<private>\d+)(?:/(?P<private_topic>\d+))?/(?P<private_msg>\d+)"  # private (optional topic)
+    r"|b/(?P<bot>\w+)/(?P<bot_msg>\d+)"                                       # bot chat
+    r"|(?P<public>[A-Za-z]\w{3,})(?:/(?P<public_topic>\d+))?/(?P<public_msg>\d+)"  # public (optional topic)
+    r")"
+    r"(?:[ \t]*-[ \t]*(?P<to>\d+))?",                                          # optional "-to" range
+    re.IGNORECASE
+)
+
+class ParsedLink:
+    """One t.me link: kind is "public", "private", "bot" or "invite"."""
+    __slots__ = ("kind", "chat", "topic_id", "from_id", "to_id", "invite")
+
+    def __init__(self, kind, chat=None, topic_id=None, from_id=None, to_id=None, invite=None):
+        self.kind = kind
+        self.chat = chat          # username (public/bot) or -100... id (private)
+        self.topic_id = topic_id
+        self.from_id = from_id
+        self.to_id = to_id
+        self.invite = invite
+
+    @property
+    def count(self):
+        return self.to_id - self.from_id + 1 if self.from_id is not None else 0
+
+    def url(self):
+        """Canonical link text (what process_links_logic accepts)"""
+        if self.kind == "invite":
+            return f"https://t.me/{self.invite}"
+        if self.kind == "private":
+            head = f"c/{str(self.chat)[4:]}"
+        elif self.kind == "bot":
+            head = f"b/{self.chat}"
+        else:
+            head = self.chat
+        topic = f"/{self.topic_id}" if self.topic_id else ""
+        rng = f"-{self.to_id}" if self.to_id != self.from_id else ""
+        return f"https://t.me/{head}{topic}/{self.from_id}{rng}"
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedLink) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return f"ParsedLink({self.url()!r})"
+
+def _link_from_match(m):
+    if m["invite"]:
+        return ParsedLink("invite", invite=m["invite"])
+    if m["private"]:
+        kind, chat, topic, msg_id = "private", int("-100" + m["private"]), m["private_topic"], m["private_msg"]
+    elif m["bot"]:
+        kind, chat, topic, msg_id = "bot", m["bot"], None, m["bot_msg"]
+    else:
+        kind, chat, topic, msg_id = "public", m["public"], m["public_topic"], m["public_msg"]
+    from_id = int(msg_id)
+    to_id = int(m["to"]) if m["to"] else from_id
+    if to_id < from_id: from_id, to_id = to_id, from_id
+    return ParsedLink(kind, chat, int(topic) if topic else None, from_id, to_id)
+
+def parse_links(text):
+    """Every t.me link (with optional "-to" range) in `text`, in order, in one regex pass."""
+    return [_link_from_match(m) for m in LINK_RE.finditer(text or "")]
+
+def parse_link(text):
+    """The first t.me link in `text`, or None."""
+    m = LINK_RE.search(text or "")
+    return _link_from_match(m) if m else None
+
+# ==============================================================================
+# --- CHAT CAPABILITIES (decided once per chat, reused for every message) ---
+# ==============================================================================
+
+CHAT_CAPS_TTL = int(os.environ.get("CHAT_CAPS_TTL", "900"))
+
+class ChatCapability:
+    __slots__ = ("protected", "is_member", "bot_access")
+
+    def __init__(self, protected=False, is_member=None, bot_access=None):
+        self.protected = protected      # has_protected_content: copy/forward will be refused
+        self.is_member = is_member      # account can read the chat (None = unknown)
+        self.bot_access = bot_access    # bot itself can read the chat (None = unknown)
+
+    @property
+    def forwardable(self):
+        return not self.protected and self.is_member is not False
+
+class ChatCapabilityCache:
+    """
+    TTL cache of what an account may do in a source chat, keyed by
+    (account, chat_id). Filled by the link analyzer and by the first message
+    a task sees, so handle_private picks copy or download up front instead of
+    trying copy_message on every message of a protected chat.
+    """
+    def __init__(self, ttl=900, maxsize=5000):
+        self._cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, account, chat_id):
+        caps = self._cache.get((account, chat_id))
+        return None if caps is AsyncTTLCache._MISSING else caps
+
+    def update(self, account, chat_id, **fields):
+        caps = self.get(account, chat_id) or ChatCapability()
+        for name, value in fields.items():
+            setattr(caps, name, value)
+        self._cache.set((account, chat_id), caps)  # refreshes the TTL
+        return caps
+
+    def observe(self, account, chat_id, msg):
+        """Returns cached capabilities, deriving them from `msg` on a miss."""
+        caps = self.get(account, chat_id)
+        if caps is None:
+            caps = self.update(account, chat_id, protected=bool(getattr(msg.chat, "has_protected_content", False)), is_member=True)
+        return caps
+
+    def invalidate(self, account, chat_id):
+        self._cache.invalidate((account, chat_id))
+
+CHAT_CAPS = ChatCapabilityCache(ttl=CHAT_CAPS_TTL)
+
 async def check_link_restriction(user_id, link_text):
     """
     Analyzes the link to determine if the source content is restricted.
     Supports Topics/Threads correctly.
     """
-    # 1. Standardize the link
-    clean_text = link_text.replace("https://", "").replace("http://", "").replace("t.me/", "").replace("c/", "")
-    
-    # Remove any range "100-200" to get just the starting ID
-    if "-" in clean_text:
-        clean_text = clean_text.split("-")[0].strip()
-        
-    parts = clean_text.split("/")
-    
-    is_private = False
-    chat_id = None
-    msg_id = None
-
-    try:
-        if "t.me/b/" in link_text:
-            return False, "🤖 **Bot Link:** Content availability depends on the bot."
-            
-        # Grab the LAST part as the Message ID (Works for Topics too)
-        msg_id = int(parts[-1])
-
-        if "t.me/c/" in link_text:
-            # Private Chat
-            is_private = True
-            chat_id = int("-100" + parts[0])
-        else:
-            # Public Chat
-            chat_id = parts[0]
-            
-    except Exception:
+    # 1. Parse the link (the first message of a range is enough)
+    link = parse_link(link_text)
+    if link is None or link.kind == "invite":
         return None, "⚠️ **Could not analyze link.** (Format not recognized)"
+    if link.kind == "bot":
+        return False, "🤖 **Bot Link:** Content availability depends on the bot."
+
+    is_private = link.kind == "private"
+    chat_id = link.chat
+    msg_id = link.from_id
 
     # 2. Select the Client (User vs Bot)
     check_client = app # Default to Bot for public links
@@ -288,12 +1196,9 @@ async def check_link_restriction(user_id, link_text):
         if not user_session:
             return None, "🔒 **Private Link:** Please /login to verify restrictions."
         
-        # Connect a temporary client to check
-        api_id = await db.get_api_id(user_id)
-        api_hash = await db.get_api_hash(user_id)
-        check_client = Client(":memory:", session_string=user_session, api_id=api_id, api_hash=api_hash, no_updates=True)
+        # Borrow the user's pooled client
         try: 
-            await check_client.connect()
+            check_client = await USER_CLIENTS.acquire(user_id)
         except: 
             return None, "❌ **Login Failed:** Could not verify restriction."
 
@@ -308,178 +1213,383 @@ async def check_link_restriction(user_id, link_text):
         # CRITICAL CHECK:
         # 1. msg.chat.has_protected_content = The whole channel/group is restricted
         # 2. msg.has_protected_content = This specific message is restricted
-        if getattr(msg.chat, "has_protected_content", False) or getattr(msg, "has_protected_content", False):
+        chat_protected = bool(getattr(msg.chat, "has_protected_content", False))
+        if not msg.empty:
+            CHAT_CAPS.update(user_account(user_id), chat_id, protected=chat_protected, is_member=True)
+            if check_client is app: CHAT_CAPS.update(user_account(user_id), chat_id, bot_access=True)
+        if chat_protected or getattr(msg, "has_protected_content", False):
             is_restricted = True
             status_msg = "🔒 **Source is RESTRICTED** (Will use Download Mode)"
         else:
             is_restricted = False
             status_msg = "🔓 **Source is PUBLIC/UNRESTRICTED** (Will use Fast Forward)"
             
+    except AuthKeyUnregistered:
+        await USER_CLIENTS.invalidate(user_id, check_client)
+        status_msg = "❌ **Session Expired:** Please /logout and /login again."
     except Exception as e:
         if "CHANNEL_PRIVATE" in str(e) or "USER_NOT_PARTICIPANT" in str(e):
+            CHAT_CAPS.update(user_account(user_id), chat_id, is_member=False, bot_access=False if check_client is app else None)
             status_msg = "⚠️ **Private Chat:** I can't check yet (You need to join first)."
         else:
             status_msg = f"⚠️ **Check Failed:** `{str(e)[:30]}...`"
     
     # Cleanup
     if is_private and user_session:
-        try: await check_client.disconnect()
-        except: pass
+        await USER_CLIENTS.release(user_id, check_client)
         
     return is_restricted, status_msg    
     
-async def split_file_python(file_path, chunk_size=1900*1024*1024):
-    loop = asyncio.get_running_loop()
-    # Run the blocking logic in a separate thread
-    return await loop.run_in_executor(io_executor, _split_file_sync, file_path, chunk_size)
+class FileSlice(io.RawIOBase):
+    """
+    Read-only, seekable file-like view over bytes [offset, offset+length) of a
+    file. Reads go through os.pread, so "splitting" a file writes nothing and
+    each slice can be handed to send_document directly.
+    """
+    def __init__(self, path, offset: int, length: int, name: str = None):
+        super().__init__()
+        self.path = str(path)
+        self.offset = offset
+        self.length = length
+        self.name = name or os.path.basename(self.path)
+        self._pos = 0
+        self._fd = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
 
-# Move the actual logic to a sync helper function
-def _split_file_sync(file_path, chunk_size):
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET: new_pos = pos
+        elif whence == os.SEEK_CUR: new_pos = self._pos + pos
+        elif whence == os.SEEK_END: new_pos = self.length + pos
+        else: raise ValueError(f"invalid whence: {whence}")
+        if new_pos < 0:
+            raise ValueError("negative seek position")
+        self._pos = new_pos
+        return new_pos
+
+    def readinto(self, b):
+        data = self.pread(len(b), self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def pread(self, size: int, pos: int) -> bytes:
+        """Reads up to `size` bytes at slice position `pos` without moving the cursor (thread-safe)."""
+        size = min(size, self.length - pos)
+        if size <= 0:
+            return b""
+        if self._fd is None:
+            # Opened lazily so slices can be created before the file is fully downloaded
+            self._fd = os.open(self.path, os.O_RDONLY)
+        return os.pread(self._fd, size, self.offset + pos)
+
+    def close(self):
+        if self._fd is not None:
+            try: os.close(self._fd)
+            except OSError: pass
+            self._fd = None
+        super().close()
+
+def make_file_slices(file_path, file_size: int, chunk_size: int):
+    """O(1) split: returns FileSlice views named `<file>.partNNN`, no bytes copied."""
     file_path = Path(file_path)
-    if not file_path.exists():
-        return []
-    part_num = 0
-    parts = []
-    buffer_size = 10 * 1024 * 1024
-    file_size = os.path.getsize(file_path)
-    
-    if file_size <= chunk_size:
-        return [file_path]
-        
-    with open(file_path, 'rb') as source:
-        while True:
-            part_name = file_path.parent / f"{file_path.name}.part{part_num:03d}"
-            current_chunk_size = 0
-            with open(part_name, 'wb') as dest:
-                while current_chunk_size < chunk_size:
-                    read_size = min(buffer_size, chunk_size - current_chunk_size)
-                    data = source.read(read_size)
-                    if not data:
-                        break
-                    dest.write(data)
-                    current_chunk_size += len(data)
-            if current_chunk_size == 0:
-                if os.path.exists(part_name):
-                    os.remove(part_name)
-                break
-            parts.append(part_name)
-            part_num += 1
-    return parts
+    return [
+        FileSlice(file_path, offset, min(chunk_size, file_size - offset), name=f"{file_path.name}.part{num:03d}")
+        for num, offset in enumerate(range(0, file_size, chunk_size))
+    ]
+
+async def download_into_slices(acc, msg: Message, file_path, file_size: int, slices, ready, status_message: Message, task_uuid=None, refresh=None):
+    """
+    Streams `msg` into file_path and sets ready[i] as soon as slices[i] is
+    fully on disk, so part uploads can start while the download continues.
+    All events are set on exit; callers check the task result for errors.
+    """
+    loop = asyncio.get_running_loop()
+    state = {"next_part": 0}
+
+    def mark_ready(written):
+        while state["next_part"] < len(slices) and written >= slices[state["next_part"]].offset + slices[state["next_part"]].length:
+            ready[state["next_part"]].set()
+            state["next_part"] += 1
+
+    try:
+        if DOWNLOAD_CONNECTIONS > 1:
+            try:
+                await parallel_download(acc, msg, file_path, file_size, status_message, task_uuid, refresh=refresh, on_prefix=mark_ready)
+                return
+            except FloodWait: raise
+            except Exception as e:
+                if "CANCELLED" in str(e): raise
+                # Slices already marked ready may be uploading: reopening "wb" would truncate them
+                if state["next_part"]: raise
+                print(f"Parallel download failed, using single connection: {e}")
+        written = 0
+        with open(file_path, "wb") as f:
+            async for chunk in acc.stream_media(msg):
+                await loop.run_in_executor(io_executor, f.write, chunk)
+                written += len(chunk)
+                progress(written, file_size, status_message, "down", task_uuid)
+                await loop.run_in_executor(io_executor, f.flush)
+                mark_ready(written)
+        if written < file_size:
+            raise Exception(f"DOWNLOAD_INCOMPLETE: {written}/{file_size} bytes")
+    finally:
+        for event in ready:
+            event.set()
   
+class ProgressRecord:
+    __slots__ = ("task_uuid", "current", "total", "speed", "eta", "updated", "last_time", "last_current")
+
+    def __init__(self, task_uuid, total, now):
+        self.task_uuid = task_uuid
+        self.current = 0
+        self.total = total
+        self.speed = 0.0
+        self.eta = None
+        self.updated = now
+        self.last_time = now
+        self.last_current = 0
+
+    @property
+    def percent(self):
+        return (self.current / self.total) * 100.0 if self.total > 0 else 0.0
+
+class ProgressRegistry:
+    """
+    Bounded store of transfer progress keyed by (unit, "down"/"up"), where a
+    unit is one message's transfer. Records expire after `ttl` seconds without
+    updates, the oldest are evicted past `maxsize`, and the records of each task
+    are indexed for /status. Speed is an EWMA over >= 1s samples.
+    """
+    def __init__(self, ttl=300, maxsize=5000, alpha=0.3):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.alpha = alpha
+        self._records = OrderedDict()  # (unit, typ) -> ProgressRecord, least recently updated first
+        self._by_task = {}  # task_uuid -> {(unit, typ): None}
+
+    def __len__(self):
+        return len(self._records)
+
+    def update(self, unit, typ, current, total, task_uuid=None):
+        key = (unit, typ)
+        now = time.time()
+        rec = self._records.get(key)
+        if rec is None:
+            rec = self._records[key] = ProgressRecord(task_uuid, int(total), now)
+            if len(self._records) > self.maxsize:
+                self._drop(next(iter(self._records)))
+        else:
+            self._records.move_to_end(key)
+        if task_uuid:
+            self._by_task.setdefault(task_uuid, {})[key] = None
+
+        rec.current = int(current)
+        rec.total = int(total)
+        rec.updated = now
+        dt = now - rec.last_time
+        if dt >= 1 or current == total:
+            if dt <= 0: dt = 0.1
+            sample = (current - rec.last_current) / dt
+            rec.speed = sample if rec.speed <= 0 else self.alpha * sample + (1 - self.alpha) * rec.speed
+            rec.last_time = now
+            rec.last_current = current
+            rec.eta = (total - current) / rec.speed if rec.speed > 0 and total > current else None
+        self.expire(now)
+        return rec
+
+    def get(self, unit, typ):
+        return self._records.get((unit, typ))
+
+    def reset(self, unit, typ):
+        self._drop((unit, typ))
+
+    def discard(self, unit):
+        for typ in ("down", "up"):
+            self._drop((unit, typ))
+
+    def snapshot(self, task_uuid):
+        """Combined record of a task's units in flight, or None."""
+        keys = self._by_task.get(task_uuid)
+        recs = [self._records[key] for key in keys] if keys else []
+        if len(recs) <= 1:
+            return recs[0] if recs else None
+        agg = ProgressRecord(task_uuid, sum(rec.total for rec in recs), time.time())
+        agg.current = sum(rec.current for rec in recs)
+        agg.speed = sum(rec.speed for rec in recs)
+        agg.eta = (agg.total - agg.current) / agg.speed if agg.speed > 0 and agg.total > agg.current else None
+        return agg
+
+    def expire(self, now=None):
+        cutoff = (now or time.time()) - self.ttl
+        while self._records:
+            key, rec = next(iter(self._records.items()))
+            if rec.updated >= cutoff:
+                break
+            self._drop(key)
+
+    def _drop(self, key):
+        rec = self._records.pop(key, None)
+        keys = self._by_task.get(rec.task_uuid) if rec and rec.task_uuid else None
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._by_task[rec.task_uuid]
+
+PROGRESS = ProgressRegistry()
+
+class ProgressUnit:
+    """
+    One message's transfer shown on a (possibly shared) status message. It is
+    passed to progress() in place of the status message, so pipelined units
+    of a batch keep separate records instead of resetting each other's.
+    """
+    __slots__ = ("id", "key")
+
+    def __init__(self, msg_id, unit):
+        self.id = msg_id  # Status message
+        self.key = (msg_id, unit)
+
 def progress(current, total, message, typ, task_uuid=None):
     if task_uuid and CANCEL_FLAGS.get(task_uuid):
         raise Exception("CANCELLED_BY_USER")
 
-    try:
-        msg_id = int(message.id)
-    except:
+    if isinstance(message, ProgressUnit):
+        msg_id, unit = message.id, message.key
+    else:
         try:
-            msg_id = int(message)
+            msg_id = int(message.id)
         except:
-            return
-    key = f"{msg_id}:{typ}"
-    now = time.time()
-    if key not in PROGRESS:
-        PROGRESS[key] = {
-            "current": 0, "total": int(total), "percent": 0.0,
-            "last_time": now, "last_current": 0, "speed": 0.0, "eta": None
-        }
-    rec = PROGRESS[key]
-    rec["current"] = int(current)
-    rec["total"] = int(total)
-    if total > 0:
-        rec["percent"] = (current / total) * 100.0
-    dt = now - rec["last_time"]
-    if dt >= 1 or current == total:
-        delta_bytes = current - rec["last_current"]
-        if dt <= 0: dt = 0.1
-        speed = delta_bytes / dt
-        rec["speed"] = speed
-        rec["last_time"] = now
-        rec["last_current"] = current
-        if speed > 0 and total > current:
-            rec["eta"] = (total - current) / speed
-            
-async def downstatus(client: Client, status_message: Message, chat, index: int, total_count: int):
-    msg_id = status_message.id
-    key = f"{msg_id}:down"
-    last_text = ""
-    while True:
-        rec = PROGRESS.get(key)
-        if not rec:
-            await asyncio.sleep(1)
-            continue
-        if rec["current"] == rec["total"] and rec["total"] > 0:
-            break
-            
-        # ... (keep all the calculation code here: percent, speed, bar, etc.) ...
-        
-        # --- NEW STYLE ---
-        status = (
-            f"📥 **Downloading File ({index}/{total_count})**\n"
-            f"└ 📂 `{max(0, total_count-index)}` remaining\n\n"
-            f"**{rec.get('percent', 0):.1f}%** │ `{generate_bar(rec.get('percent', 0), length=12)}`\n\n"
-            f"🚀 **Speed:** `{_pretty_bytes(rec.get('speed', 0))}/s`\n"
-            f"💾 **Size:** `{_pretty_bytes(rec.get('current', 0))} / {_pretty_bytes(rec.get('total', 0))}`\n"
-            f"⏳ **ETA:** `{get_readable_time(int(rec.get('eta', 0)) if rec.get('eta') else 0)}`"
-        )
-        # -----------------
-
-        if status != last_text:
             try:
-                await client.edit_message_text(chat, msg_id, status)
-                last_text = status
+                msg_id = int(message)
             except:
-                pass
-        
-        # FIX: Changed from 10 to 20 seconds
-        await asyncio.sleep(20) 
-        
-    try:
-        await client.edit_message_text(chat, msg_id, f"✅ **Download Complete** ({index}/{total_count})\n⚡ **Processing file...**")
-    except:
-        pass
-        
-async def upstatus(client: Client, status_message: Message, chat, index: int, total_count: int):
-    msg_id = status_message.id
-    key = f"{msg_id}:up"
-    last_text = ""
-    while True:
-        rec = PROGRESS.get(key)
-        if not rec:
-            await asyncio.sleep(1)
-            continue
-        if rec["current"] == rec["total"] and rec["total"] > 0:
-            break
+                return
+        unit = msg_id
+    PROGRESS.update(unit, typ, current, total, task_uuid)
+    PROGRESS_HUB.notify(msg_id)
             
-        # ... (keep all the calculation code here) ...
-
-        # --- NEW STYLE ---
-        status = (
-            f"☁️ **Uploading File ({index}/{total_count})**\n"
-            f"└ 📤 `{max(0, total_count-index)}` remaining\n\n"
-            f"**{rec.get('percent', 0):.1f}%** │ `{generate_bar(rec.get('percent', 0), length=12)}`\n\n"
-            f"🚀 **Speed:** `{_pretty_bytes(rec.get('speed', 0))}/s`\n"
-            f"💾 **Size:** `{_pretty_bytes(rec.get('current', 0))} / {_pretty_bytes(rec.get('total', 0))}`\n"
-            f"⏳ **ETA:** `{get_readable_time(int(rec.get('eta', 0)) if rec.get('eta') else 0)}`"
+PROGRESS_EDIT_INTERVAL = int(os.environ.get("PROGRESS_EDIT_INTERVAL", "20"))
+
+def render_progress(typ: str, rec: ProgressRecord, index: int, total_count: int) -> str:
+    if rec.total > 0 and rec.current >= rec.total:
+        if typ == "down":
+            return f"✅ **Download Complete** ({index}/{total_count})\n⚡ **Processing file...**"
+        return f"✅ **Upload Complete** ({index}/{total_count})"
+    if typ == "down":
+        header = f"📥 **Downloading File ({index}/{total_count})**\n└ 📂 `{max(0, total_count-index)}` remaining\n\n"
+    else:
+        header = f"☁️ **Uploading File ({index}/{total_count})**\n└ 📤 `{max(0, total_count-index)}` remaining\n\n"
+    return (
+        header +
+        f"**{rec.percent:.1f}%** │ `{generate_bar(rec.percent, length=12)}`\n\n"
+        f"🚀 **Speed:** `{_pretty_bytes(rec.speed)}/s`\n"
+        f"💾 **Size:** `{_pretty_bytes(rec.current)} / {_pretty_bytes(rec.total)}`\n"
+        f"⏳ **ETA:** `{get_readable_time(int(rec.eta) if rec.eta else 0)}`"
+    )
+
+def render_units(units, total_count: int) -> str:
+    """Status text for several units in flight on one status message: [(typ, index, rec)]."""
+    units = sorted(units, key=lambda u: u[1])
+    first, last = units[0][1], units[-1][1]
+    lines = [f"⚙️ **Processing Files ({first}-{last}/{total_count})**\n└ 📂 `{max(0, total_count-last)}` remaining\n"]
+    for typ, index, rec in units:
+        icon = "📥" if typ == "down" else "☁️"
+        lines.append(
+            f"{icon} `#{index}` **{rec.percent:.1f}%** │ `{_pretty_bytes(rec.speed)}/s` │ "
+            f"⏳ `{get_readable_time(int(rec.eta) if rec.eta else 0)}`"
         )
-        # -----------------
+    lines.append(f"\n🚀 **Speed:** `{_pretty_bytes(sum(rec.speed for _, _, rec in units))}/s`")
+    return "\n".join(lines)
 
-        if status != last_text:
-            try:
-                await client.edit_message_text(chat, msg_id, status)
-                last_text = status
-            except:
-                pass
-        
-        # FIX: Changed from 10 to 20 seconds
-        await asyncio.sleep(20)
+class ProgressHub:
+    """
+    Event-driven status renderer. Transfers push updates through progress();
+    one renderer task per status message coalesces them into at most one edit
+    per PROGRESS_EDIT_INTERVAL and exits when its last unit end()s. Pipelined
+    units of a batch each begin() their own unit and are rendered together.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._views = {}  # status msg_id -> view dict
+
+    def begin(self, client: Client, status_message: Message, chat, typ: str, index: int, total_count: int, unit=None) -> ProgressUnit:
+        """Starts (or switches) a unit's phase on a status message: 'down' or 'up'."""
+        msg_id = status_message.id
+        tracker = ProgressUnit(msg_id, unit)
+        PROGRESS.reset(tracker.key, typ)  # Drop a stale record of this phase
+        view = self._views.get(msg_id)
+        if view is None:
+            view = {"changed": asyncio.Event(), "closed": asyncio.Event(), "last_text": "", "units": {}}
+            self._views[msg_id] = view
+            view["task"] = asyncio.create_task(self._render_loop(msg_id, view))
+        view["units"][tracker.key] = (typ, index)
+        view.update(client=client, chat=chat, total_count=total_count)
+        return tracker
+
+    def notify(self, msg_id: int):
+        view = self._views.get(msg_id)
+        if view:
+            view["changed"].set()
+
+    def end(self, msg_id: int, unit=None):
+        key = (msg_id, unit)
+        PROGRESS.discard(key)
+        view = self._views.get(msg_id)
+        if not view:
+            return
+        view["units"].pop(key, None)
+        if view["units"]:
+            view["changed"].set()  # Re-render without this unit
+            return
+        del self._views[msg_id]
+        view["closed"].set()
+        view["changed"].set()
+
+    async def _render_loop(self, msg_id, view):
+        last_edit = 0.0
+        try:
+            while True:
+                await view["changed"].wait()
+                # Coalesce every update until the next edit is allowed (or we are closed)
+                wait = self.interval - (time.time() - last_edit)
+                if wait > 0 and not view["closed"].is_set():
+                    try: await asyncio.wait_for(view["closed"].wait(), timeout=wait)
+                    except asyncio.TimeoutError: pass
+                view["changed"].clear()
+                if view["closed"].is_set():
+                    return
+                units = []
+                for key, (typ, index) in list(view["units"].items()):
+                    rec = PROGRESS.get(key, typ)
+                    if rec:
+                        units.append((typ, index, rec))
+                if not units:
+                    continue
+                if len(units) == 1:
+                    typ, index, rec = units[0]
+                    status = render_progress(typ, rec, index, view["total_count"])
+                else:
+                    status = render_units(units, view["total_count"])
+                if status != view["last_text"]:
+                    try:
+                        await view["client"].edit_message_text(view["chat"], msg_id, status)
+                        view["last_text"] = status
+                    except FloodWait as e:
+                        await asyncio.sleep(e.value)
+                    except: pass
+                    last_edit = time.time()
+        except Exception as e:
+            print(f"Progress Renderer Error: {e}")
+
+PROGRESS_HUB = ProgressHub(PROGRESS_EDIT_INTERVAL)
 
-    try:
-        await client.edit_message_text(chat, msg_id, f"✅ **Upload Complete** ({index}/{total_count})")
-    except:
-        pass
-        
 def get_message_type(msg: Message):
     if msg.document: return "Document"
     if msg.video: return "Video"
@@ -502,8 +1612,7 @@ async def send_start(client: Client, message: Message):
     user_name = message.from_user.first_name
     
     try:
-        if not await db.is_user_exist(user_id):
-            await db.add_user(user_id, user_name)
+        if await db.add_user(user_id, user_name):
             print(f"New user {user_id} saved to database.") # Simple logging
     except Exception as e:
         print(f"Failed to save user {user_id}: {e}")
@@ -553,9 +1662,9 @@ async def send_cancel(client: Client, message: Message):
         await message.reply("✅ **Setup process cancelled.** You can send a new link now.")
         return
 
-    # 2. Check if user has active downloads running
+    # 2. Check if user has active downloads running (or tasks waiting in the queue)
     user_tasks = ACTIVE_PROCESSES.get(user_id, {})
-    if not user_tasks:
+    if not user_tasks and not SCHEDULER.queued(user_id):
         await message.reply("✅ **No active tasks to cancel.**")
         return
 
@@ -589,15 +1698,24 @@ async def cancel_callback(client: Client, query):
 
     if data == "cancel_all":
         user_tasks = list(ACTIVE_PROCESSES.get(user_id, {}).keys())
-        if not user_tasks:
+        composites = [job for job in COMPOSITE_JOBS.values() if job.user_id == user_id]
+        # Queued tasks never start: otherwise the next one to launch would reset IS_BATCH and carry on
+        dropped = SCHEDULER.cancel_queued(user_id)
+        if not user_tasks and not dropped and not composites:
             await query.answer("No active tasks to cancel.", show_alert=True)
             try: await query.message.delete()
             except: pass
             return
+        for job in composites:
+            CANCEL_FLAGS[job.id] = True
         for tid in user_tasks:
             CANCEL_FLAGS[tid] = True
         batch_temp.IS_BATCH[user_id] = True
-        await query.message.edit("**🛑 Cancelling ALL your tasks...**\n(This may take a moment to stop current downloads)")
+        for on_drop in dropped:
+            try: await on_drop()
+            except Exception as e: print(f"Cancel Error: {e}")
+        note = f"\n`{len(dropped)}` queued task(s) removed." if dropped else ""
+        await query.message.edit(f"**🛑 Cancelling ALL your tasks...**\n(This may take a moment to stop current downloads){note}")
         return
 
     if data.startswith("cancel_task:"):
@@ -637,15 +1755,32 @@ async def status_style_handler(client, message):
         for uid, tasks in ACTIVE_PROCESSES.items():
             for t_id, info in tasks.items():
                 active_count += 1
-                queue_list.append(f"• {info.get('user')} → `{info.get('item')[:20]}...`")
+                line = f"• {info.get('user')} → `{info.get('item')[:20]}...`"
+                rec = PROGRESS.snapshot(t_id)
+                if rec:
+                    line += f" `{rec.percent:.0f}%` @ `{_pretty_bytes(rec.speed)}/s`"
+                queue_list.append(line)
     
     queue_text = "\n".join(queue_list) if queue_list else "😴 No active tasks."
 
+    sched = SCHEDULER.snapshot()
+    pools = sched["pools"]
+    sched_text = (
+        f"🗂 **Scheduler:** `{sched['running']}` running / `{sched['queued']}` queued\n"
+        f"⬇️ `{pools['download'][0]}/{pools['download'][1]}`  │  "
+        f"⬆️ `{pools['upload'][0]}/{pools['upload'][1]}`  │  "
+        f"⏩ `{pools['forward'][0]}/{pools['forward'][1]}`\n"
+        f"♻️ **Media Cache:** `{MEDIA_CACHE_STATS['hits']}` hits / `{MEDIA_CACHE_STATS['misses']}` misses / "
+        f"`{MEDIA_CACHE_STATS['stale']}` stale (`{media_cache_hit_rate():.0f}%`)"
+    )
+
     msg = (
         f"🔰 **SYSTEM DASHBOARD**\n\n"
         f"⏱ **Uptime:** `{uptime_str}`\n"
         f"🧠 **RAM:** `{mem}%`  │  ⚙️ **CPU:** `{cpu}%`\n"
-        f"💿 **Disk:** `{disk_free}` free / `{disk_total}` total\n\n"
+        f"🐢 **Loop Lag:** `{LOOP_MONITOR.lag * 1000:.0f}ms` (max `{LOOP_MONITOR.max_lag * 1000:.0f}ms`, `{LOOP_MONITOR.stalls}` stalls)\n"
+        f"💿 **Disk:** `{disk_free}` free / `{disk_total}` total\n"
+        f"{sched_text}\n\n"
         f"📉 **Active Tasks ({active_count})**\n"
         f"{queue_text}"
     )
@@ -662,6 +1797,48 @@ async def bot_stats_handler(client: Client, message: Message):
         f"**Logged-in Users:** `{session_users}` (Users with a saved session)"
     )
 
+PROFILE_LOCK = asyncio.Lock()
+
+@app.on_message(filters.command(["profile"]) & filters.user(ADMINS))
+async def profile_handler(client: Client, message: Message):
+    """/profile [seconds] [top] - cProfile the live event loop and reply with the hottest functions"""
+    args = message.command[1:]
+    try:
+        seconds = min(300, max(1, int(args[0]))) if args else 30
+        top = min(200, max(5, int(args[1]))) if len(args) > 1 else 40
+    except ValueError:
+        return await message.reply("**Usage:** `/profile [seconds] [top]`")
+    if PROFILE_LOCK.locked():
+        return await message.reply("⏳ **A profile is already running.**")
+
+    async with PROFILE_LOCK:
+        status = await message.reply(f"🔬 **Profiling for** `{seconds}s`...")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        out.write(f"=== Top {top} by own time ===\n")
+        stats.sort_stats("tottime").print_stats(top)
+        out.write(f"=== Top {top} by cumulative time ===\n")
+        stats.sort_stats("cumulative").print_stats(top)
+
+        report = io.BytesIO(out.getvalue().encode())
+        report.name = f"profile_{int(time.time())}.txt"
+        await message.reply_document(
+            report,
+            caption=(
+                f"🔬 **Profile:** `{seconds}s`, top `{top}`\n"
+                f"🐢 **Loop Lag:** `{LOOP_MONITOR.lag * 1000:.0f}ms` (max `{LOOP_MONITOR.max_lag * 1000:.0f}ms`, `{LOOP_MONITOR.stalls}` stalls)"
+            )
+        )
+        try: await status.delete()
+        except: pass
+
 # ==============================================================================
 # --- LOGIN / LOGOUT (async login handler inserted) ---
 # ==============================================================================
@@ -675,27 +1852,15 @@ async def logout(client, message):
     status_msg = await message.reply("📡 **Connecting to Telegram to terminate session...**")
 
     # 1. Get session details needed to connect
-    session_string = await db.get_session(user_id)
-    api_id = await db.get_api_id(user_id)
-    api_hash = await db.get_api_hash(user_id)
+    creds = await db.get_user_credentials(user_id) or {}
+    session_string = creds.get("session")
 
     # 2. Perform Remote Logout (Remove from Devices)
     if session_string:
         user_client = None
         try:
-            # Use stored keys or fallback to global env
-            use_api_id = int(api_id) if api_id else API_ID
-            use_api_hash = api_hash if api_hash else API_HASH
-            
-            user_client = Client(
-                ":memory:", 
-                session_string=session_string, 
-                api_id=use_api_id, 
-                api_hash=use_api_hash,
-                no_updates=True
-            )
-            
-            await user_client.connect()
+            # Reuse the pooled connection (falls back to global env keys)
+            user_client = await USER_CLIENTS.acquire(user_id)
             
             # Try to logout, ignoring "Already Terminated" errors
             try:
@@ -716,23 +1881,19 @@ async def logout(client, message):
             print(f"Remote logout warning: {e}")
             await status_msg.edit("✅ **Local session cleared.** (Remote session might already be gone)")
         finally:
-            try:
-                if user_client and user_client.is_connected:
-                    await user_client.disconnect()
-            except: pass
+            if user_client:
+                await USER_CLIENTS.release(user_id, user_client)
+            await USER_CLIENTS.invalidate(user_id)
 
     # 3. Clean up Local Database
-    await db.set_session(user_id, session=None)
-    await db.set_api_id(user_id, api_id=None)
-    await db.set_api_hash(user_id, api_hash=None)
+    await db.clear_credentials(user_id)
     
     await message.reply("**Logout Complete** ♦\n(You are now disconnected)")
 
 @app.on_message(filters.private & ~filters.forwarded & filters.command(["login"]))
 async def login_handler(bot: Client, message: Message):
     
-    if not await db.is_user_exist(message.from_user.id):
-        await db.add_user(message.from_user.id, message.from_user.first_name)
+    await db.add_user(message.from_user.id, message.from_user.first_name)
         
     user_data = await db.get_session(message.from_user.id)
     if user_data is not None:
@@ -835,9 +1996,7 @@ async def login_handler(bot: Client, message: Message):
             uclient = Client(":memory:", session_string=string_session, api_id=api_id, api_hash=api_hash)
             await uclient.connect()
             
-            await db.set_session(message.from_user.id, session=string_session)
-            await db.set_api_id(message.from_user.id, api_id=api_id)
-            await db.set_api_hash(message.from_user.id, api_hash=api_hash)
+            await db.set_credentials(message.from_user.id, string_session, api_id, api_hash)
             
             try:
                 await uclient.disconnect()
@@ -851,78 +2010,220 @@ async def login_handler(bot: Client, message: Message):
 # --- BROADCAST ---
 # ==============================================================================
 
-async def broadcast_messages(user_id, message):
-    start_time = time.time()
-    try:
-        await message.copy(chat_id=user_id)
-        # Calculates sleep based on work time
-        elapsed = time.time() - start_time
-        await asyncio.sleep(max(0, 1.5 - elapsed)) 
-        return True, "Success"
-    except FloodWait as e:
-        # If floodwait is huge, just skip this user to save the broadcast
-        if e.value > 60:
-            return False, "Error"
-        await asyncio.sleep(e.value)
-        return await broadcast_messages(user_id, message)
-    except InputUserDeactivated:
-        await db.delete_user(int(user_id))
-        return False, "Deleted"
-    except UserIsBlocked:
-        await db.delete_user(int(user_id))
-        return False, "Blocked"
-    except PeerIdInvalid:
-        await db.delete_user(int(user_id))
-        return False, "Error"
-    except Exception as e:
-        return False, "Error"
+BROADCAST_PAGE = 500          # users fetched (and checkpointed) per step
+BROADCAST_EDIT_INTERVAL = 10  # seconds between status edits
+
+class BroadcastEngine:
+    """
+    Sends one message to every user with a pool of BROADCAST_WORKERS senders
+    sharing a single RATE_LIMITER bucket (~BROADCAST_RATE msgs/s, halved on
+    FloodWait). Users are walked in id order one page at a time; after each
+    page, dead users are removed with one bulk_write and the last id is
+    checkpointed, so a restart resumes the broadcast after that page.
+    """
+    def __init__(self):
+        self.job = None
+        self.task = None
+        self.cancelled = False
+        self._last_edit = 0.0
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    async def start(self, client: Client, source: Message, status: Message):
+        total = await db.total_users_count()
+        self.job = {
+            '_id': uuid.uuid4().hex,
+            'source_chat_id': source.chat.id, 'source_msg_id': source.id,
+            'status_chat_id': status.chat.id, 'status_msg_id': status.id,
+            'total': total, 'last_user_id': None, 'started': time.time(),
+            'counts': {'success': 0, 'blocked': 0, 'deleted': 0, 'failed': 0},
+        }
+        await db.save_broadcast(self.job)
+        self._launch(client)
+
+    async def resume(self, client: Client):
+        try:
+            job = await db.get_active_broadcast()
+        except Exception as e:
+            print(f"Broadcast Journal Error: {e}")
+            return
+        if not job: return
+        self.job = job
+        self._launch(client)
+        print(f"♻️ Resumed broadcast {job['_id'][:8]} after user {job.get('last_user_id')}")
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _launch(self, client):
+        self.cancelled = False
+        self.task = asyncio.create_task(self._run(client))
+
+    def status_text(self, title="Broadcast in progress"):
+        job = self.job
+        c = job['counts']
+        done = sum(c.values())
+        elapsed = max(1e-6, time.time() - job['started'])
+        rate = done / elapsed
+        eta = get_readable_time(int((job['total'] - done) / rate)) if rate > 0 and job['total'] > done else "-"
+        return (
+            f"**{title}:**\n\n"
+            f"**Total Users:** `{job['total']}`\n"
+            f"**Completed:** `{done}` / `{job['total']}`\n"
+            f"**Success:** `{c['success']}`\n"
+            f"**Blocked:** `{c['blocked']}`\n"
+            f"**Deleted:** `{c['deleted']}`\n"
+            f"**Failed:** `{c['failed']}`\n"
+            f"**Speed:** `{rate:.1f}` msgs/s  │  **ETA:** `{eta}`"
+        )
+
+    async def _edit_status(self, client, text, force=False):
+        now = time.time()
+        if not force and now - self._last_edit < BROADCAST_EDIT_INTERVAL: return
+        self._last_edit = now
+        try: await client.edit_message_text(self.job['status_chat_id'], self.job['status_msg_id'], text)
+        except Exception: pass
+
+    async def _send(self, client, user_id):
+        """Returns 'success', 'blocked', 'deleted', 'invalid' or 'failed'."""
+        key = rate_key("bot", "broadcast", "broadcast")
+        while True:
+            await RATE_LIMITER.acquire(key)
+            try:
+                await client.copy_message(user_id, self.job['source_chat_id'], self.job['source_msg_id'])
+                RATE_LIMITER.success(key)
+                return "success"
+            except FloodWait as e:
+                RATE_LIMITER.flood(key, e.value)
+                # If floodwait is huge, just skip this user to save the broadcast
+                if e.value > 60: return "failed"
+            except InputUserDeactivated: return "deleted"
+            except UserIsBlocked: return "blocked"
+            except PeerIdInvalid: return "invalid"
+            except Exception: return "failed"
+
+    async def _send_page(self, client, user_ids):
+        pending = iter(user_ids)
+        dead = []
+        counts = self.job['counts']
+
+        async def sender():
+            for user_id in pending:
+                if self.cancelled: return
+                result = await self._send(client, user_id)
+                if result in ("blocked", "deleted", "invalid"): dead.append(user_id)
+                counts["failed" if result == "invalid" else result] += 1
+                await self._edit_status(client, self.status_text())
+
+        await asyncio.gather(*(sender() for _ in range(min(BROADCAST_WORKERS, len(user_ids)))))
+        return dead
+
+    async def _run(self, client):
+        job = self.job
+        try:
+            after_id = job.get('last_user_id')
+            while not self.cancelled:
+                user_ids = await db.get_user_ids_page(after_id, BROADCAST_PAGE)
+                if not user_ids: break
+                dead = await self._send_page(client, user_ids)
+                try: await db.delete_users_bulk(dead)
+                except Exception as e: print(f"Broadcast Cleanup Error: {e}")
+                if self.cancelled: break
+                after_id = user_ids[-1]
+                await db.checkpoint_broadcast(job['_id'], after_id, job['counts'])
+        except asyncio.CancelledError:
+            raise  # shutdown: keep the journal so the broadcast resumes
+        except Exception as e:
+            print(f"Broadcast Error: {e}")
+            await send_log(f"❌ **Broadcast Crashed**\nError: `{e}`")
+            return
+        try: await db.delete_broadcast(job['_id'])
+        except Exception: pass
+        time_taken = str(datetime.timedelta(seconds=int(time.time() - job['started'])))
+        title = "Broadcast Cancelled" if self.cancelled else f"Broadcast Completed in {time_taken}"
+        await self._edit_status(client, self.status_text(title), force=True)
+
+BROADCASTER = BroadcastEngine()
 
 @app.on_message(filters.command("broadcast") & filters.user(ADMINS) & filters.reply)
 async def broadcast(bot, message):
-    users = await db.get_all_users()
     b_msg = message.reply_to_message
     if not b_msg:
         return await message.reply_text("**Reply This Command To Your Broadcast Message**")
+    if BROADCASTER.running:
+        return await message.reply_text("**A broadcast is already running.** Use /broadcast_status or /broadcast_cancel.")
     sts = await message.reply_text(text='Broadcasting your messages...')
-    start_time = time.time()
-    total_users = await db.total_users_count()
-    done = 0
-    blocked = 0
-    deleted = 0
-    failed = 0
-    success = 0
-    async for user in users:
-        if 'id' in user:
-            pti, sh = await broadcast_messages(int(user['id']), b_msg)
-            if pti:
-                success += 1
-            elif pti == False:
-                if sh == "Blocked":
-                    blocked += 1
-                elif sh == "Deleted":
-                    deleted += 1
-                elif sh == "Error":
-                    failed += 1
-            done += 1
-            if not done % 20:
-                await sts.edit(f"Broadcast in progress:\n\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nBlocked: {blocked}\nDeleted: {deleted}")
-        else:
-            done += 1
-            failed += 1
-            if not done % 20:
-                await sts.edit(f"Broadcast in progress:\n\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nBlocked: {blocked}\nDeleted: {deleted}")
+    await BROADCASTER.start(bot, b_msg, sts)
+
+@app.on_message(filters.command("broadcast_status") & filters.user(ADMINS))
+async def broadcast_status(bot, message):
+    if not BROADCASTER.running:
+        return await message.reply_text("**No broadcast is running.**")
+    await message.reply_text(BROADCASTER.status_text())
 
-    time_taken = str(datetime.timedelta(seconds=int(time.time()-start_time)))
-    await sts.edit(f"Broadcast Completed:\nCompleted in {time_taken} seconds.\n\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nBlocked: {blocked}\nDeleted: {deleted}")
+@app.on_message(filters.command("broadcast_cancel") & filters.user(ADMINS))
+async def broadcast_cancel(bot, message):
+    if not BROADCASTER.running:
+        return await message.reply_text("**No broadcast is running.**")
+    BROADCASTER.cancel()
+    await message.reply_text("🛑 **Broadcast cancelling...** (in-flight sends finish first)")
 
 # ==============================================================================
 # --- CORE: receive links / start tasks / processing / cancel checks ---
 # ==============================================================================
 
-@app.on_message((filters.text | filters.caption) & filters.private & ~filters.command(["dl", "start", "help", "cancel", "botstats", "login", "logout", "broadcast", "status"]))
+MAX_LINK_FILE_SIZE = 1024 * 1024  # .txt link lists
+
+async def read_link_text(client: Client, message: Message):
+    """Text/caption of `message`, or the contents of an attached .txt link list."""
+    doc = message.document
+    if doc and (doc.mime_type == "text/plain" or (doc.file_name or "").lower().endswith(".txt")):
+        if doc.file_size and doc.file_size > MAX_LINK_FILE_SIZE:
+            return None
+        data = await client.download_media(message, in_memory=True)
+        return bytes(data.getbuffer()).decode("utf-8", errors="ignore")
+    return message.text or message.caption
+
+async def analyze_submission(user_id, link_text):
+    """
+    Returns (task fields, status text) for a message with one or more links.
+    Several links are checked concurrently, once per distinct chat (sharing
+    the user's pooled client), and become a single composite job.
+    """
+    links = [l for l in parse_links(link_text) if l.kind != "invite"]
+    if len(links) <= 1:
+        is_restricted, status_text = await check_link_restriction(user_id, link_text)
+        return {"link": links[0].url() if links else link_text, "is_restricted": is_restricted}, status_text
+
+    by_chat = {}
+    for link in links:
+        by_chat.setdefault((link.kind, link.chat), link)
+    results = await asyncio.gather(*(check_link_restriction(user_id, l.url()) for l in by_chat.values()))
+    verdict = {key: bool(is_restricted) for key, (is_restricted, _) in zip(by_chat, results)}
+    restricted = {l.url(): verdict[(l.kind, l.chat)] for l in links}
+
+    n_restricted = sum(restricted.values())
+    status_text = (
+        f"📦 **{len(links)} links** across `{len(by_chat)}` chats (`{sum(l.count for l in links)}` messages)\n"
+        f"🔒 Restricted: `{n_restricted}`  │  🔓 Public: `{len(links) - n_restricted}`"
+    )
+    failed_checks = [text for _, text in results if text.startswith(("⚠️", "❌", "🔒 **Private Link"))]
+    if failed_checks:
+        status_text += f"\n{failed_checks[0]}"
+    fields = {
+        "link": f"{len(links)} links",
+        "links": [l.url() for l in links],
+        "restricted": restricted,
+        "is_restricted": n_restricted > 0,
+    }
+    return fields, status_text
+
+@app.on_message((filters.text | filters.caption | filters.document) & filters.private & ~filters.command(["dl", "start", "help", "cancel", "botstats", "login", "logout", "broadcast", "broadcast_status", "broadcast_cancel", "status", "profile"]))
 async def save(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id in PENDING_TASKS:
+    if user_id in PENDING_TASKS and message.text:
         # (Keep existing setup logic for waiting_id / waiting_speed)
         if PENDING_TASKS[user_id].get("status") == "waiting_id":
             await process_custom_destination(client, message)
@@ -931,21 +2232,17 @@ async def save(client: Client, message: Message):
             await process_speed_input(client, message)
             return
 
-    link_text = message.text or message.caption
-    if not link_text or "https://t.me/" not in link_text:
+    link_text = await read_link_text(client, message)
+    if not link_text or not LINK_RE.search(link_text):
         return
 
     # --- NEW: CHECK RESTRICTION FIRST ---
     wait_msg = await message.reply("🔎 **Analyzing Link...**", quote=True)
-    is_restricted, status_text = await check_link_restriction(user_id, link_text)
+    fields, status_text = await analyze_submission(user_id, link_text)
     await wait_msg.delete()
     # ------------------------------------
 
-    PENDING_TASKS[user_id] = {
-        "link": link_text, 
-        "status": "waiting_choice",
-        "is_restricted": is_restricted 
-    }
+    PENDING_TASKS[user_id] = {**fields, "status": "waiting_choice"}
     
     buttons = [
         [InlineKeyboardButton("📂 Send to DM (Here)", callback_data="dest_dm")],
@@ -969,13 +2266,13 @@ async def dl_handler(client: Client, message: Message):
     
     # 1. Extract Link (from Reply or Command Argument)
     reply = message.reply_to_message
-    if reply and (reply.text or reply.caption):
-        link_text = reply.text or reply.caption
+    if reply and (reply.text or reply.caption or reply.document):
+        link_text = await read_link_text(client, reply) or ""
     elif len(message.command) > 1:
         link_text = message.text.split(None, 1)[1]
         
     # 2. Validate Link
-    if not link_text or "https://t.me/" not in link_text:
+    if not link_text or not LINK_RE.search(link_text):
         await message.reply_text(
             "**Usage:**\n"
             "• Reply to a link with `/dl`\n"
@@ -985,19 +2282,18 @@ async def dl_handler(client: Client, message: Message):
 
     # --- NEW: CHECK RESTRICTION FIRST ---
     wait_msg = await message.reply("🔎 **Analyzing Link...**", quote=True)
-    is_restricted, status_text = await check_link_restriction(user_id, link_text)
+    fields, status_text = await analyze_submission(user_id, link_text)
     await wait_msg.delete()
     # ------------------------------------
 
     # 3. Handle Group Chat (Directly ask for Speed)
     if message.chat.type in [enums.ChatType.GROUP, enums.ChatType.SUPERGROUP]:
         PENDING_TASKS[user_id] = {
-            "link": link_text,
+            **fields,
             "dest_chat_id": message.chat.id,
             "dest_thread_id": message.message_thread_id,
             "dest_title": message.chat.title or "This Group",
             "status": "waiting_speed",
-            "is_restricted": is_restricted # <--- ADDED THIS
         }
         # Send the status info before showing the speed menu
         await message.reply(f"✨ **Link Analyzed!**\n{status_text}", quote=True)
@@ -1005,12 +2301,7 @@ async def dl_handler(client: Client, message: Message):
         return
 
     # 4. Handle Private Chat (Show Destination Menu)
-    # CHANGE: Added "is_restricted" here too
-    PENDING_TASKS[user_id] = {
-        "link": link_text, 
-        "status": "waiting_choice",
-        "is_restricted": is_restricted
-    }
+    PENDING_TASKS[user_id] = {**fields, "status": "waiting_choice"}
     
     buttons = [
         [InlineKeyboardButton("📂 Send to DM (Here)", callback_data="dest_dm")],
@@ -1081,6 +2372,7 @@ async def process_custom_destination(client: Client, message: Message):
 
 async def ask_for_speed(message: Message):
     buttons = [
+        [InlineKeyboardButton("🤖 Auto (Adaptive)", callback_data="speed_auto")],
         [InlineKeyboardButton("⚡ Default (3s)", callback_data="speed_default")],
         [InlineKeyboardButton("⚙️ Manual Speed", callback_data="speed_manual")],
         [InlineKeyboardButton("❌ Cancel", callback_data="cancel_setup")]
@@ -1101,11 +2393,12 @@ async def speed_callback(client: Client, query):
         return
     choice = query.data
     task_data = PENDING_TASKS[user_id]
-    if choice == "speed_default":
+    if choice in ("speed_default", "speed_auto"):
         try: await query.message.delete()
         except: pass
         if user_id in PENDING_TASKS: del PENDING_TASKS[user_id]
-        await start_task_final(client, query.message, task_data, delay=3, user_id=user_id)
+        # delay=0 means "Auto": pacing comes only from the adaptive RATE_LIMITER
+        await start_task_final(client, query.message, task_data, delay=0 if choice == "speed_auto" else 3, user_id=user_id)
     elif choice == "speed_manual":
         PENDING_TASKS[user_id]["status"] = "waiting_speed"
         await query.message.edit(
@@ -1164,72 +2457,244 @@ async def send_log(text):
     except Exception as e:
         print(f"❌ Failed to send log: {e}")
 
+class DiskBudget:
+    """
+    Bytes promised to large downloads in flight (split files), so pipelined
+    units cannot together overcommit the disk past the `floor` of free space.
+    """
+    def __init__(self, floor):
+        self.floor = floor
+        self.reserved = 0
+
+    async def reserve(self, size: int):
+        free = (await _fs(shutil.disk_usage, ".")).free
+        if free - self.reserved - size < self.floor:
+            raise Exception(f"DISK_FULL: {_pretty_bytes(size)} needed, {_pretty_bytes(max(0, free - self.reserved))} free")
+        self.reserved += size
+
+    def release(self, size: int):
+        self.reserved = max(0, self.reserved - size)
+
+DISK_BUDGET = DiskBudget(500 * 1024 * 1024)
+
 async def check_disk_space():
-    """Returns False if free space is < 500MB"""
+    """Returns False if free space (minus DISK_BUDGET reservations) is < 500MB"""
     try:
         total, used, free = shutil.disk_usage(".")
-        free_mb = free / (1024 * 1024)
+        free_mb = (free - DISK_BUDGET.reserved) / (1024 * 1024)
         if free_mb < 500: # Limit: 500MB
             return False
         return True
     except:
         return True
 
-async def cleanup_watchdog():
-    """Runs every 10 mins to clean stuck download folders older than 2 hours"""
-    while True:
-        await asyncio.sleep(600) # Check every 10 mins
-        try:
-            download_path = Path("./downloads")
-            if not download_path.exists(): continue
-            
-            current_time = time.time()
-            # 2 hours in seconds
-            max_age = 2 * 60 * 60 
-            
-            for user_folder in download_path.iterdir():
-                if user_folder.is_dir():
-                    for task_folder in user_folder.iterdir():
-                        if task_folder.is_dir():
-                            folder_time = task_folder.stat().st_mtime
-                            if (current_time - folder_time) > max_age:
-                                shutil.rmtree(task_folder)
-                                await send_log(f"🧹 **Auto-Cleanup:** Deleted stuck folder `{task_folder.name}` (Older than 2h)")
-        except Exception as e:
-            print(f"Watchdog Error: {e}")
-            
-async def start_task_final(client: Client, message_context: Message, task_data: dict, delay: int, user_id: int):
+# ==============================================================================
+# --- ASYNC FILESYSTEM: blocking fs calls run on fs_executor ---
+# ==============================================================================
+
+TRASH_DIR = Path("./.trash")
+
+async def _fs(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(fs_executor, fn, *args)
+
+def _makedirs(path):
+    os.makedirs(path, exist_ok=True)
+
+def _remove_quiet(path):
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+def _move_to_trash(path):
+    """Renames `path` into TRASH_DIR (instant, same filesystem). Returns the new path or None."""
+    try:
+        TRASH_DIR.mkdir(exist_ok=True)
+        target = TRASH_DIR / uuid.uuid4().hex
+        os.rename(path, target)
+        return target
+    except FileNotFoundError:
+        return None
+
+def _delete_trees(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+async def fs_mkdir(path):
+    await _fs(_makedirs, path)
+
+async def fs_exists(path):
+    return await _fs(os.path.exists, path)
+
+async def fs_getsize(path):
+    return await _fs(os.path.getsize, path)
+
+async def fs_remove(path):
+    await _fs(_remove_quiet, path)
+
+class TreeDeleter:
+    """
+    Background deleter for directory trees. discard() renames the tree into
+    TRASH_DIR, so the original path is free again at once, and the slow
+    rmtree runs later on fs_executor in batches of up to `batch` trees.
+    """
+    def __init__(self, batch=32):
+        self.batch = batch
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+
+    async def discard(self, path):
+        try:
+            target = await _fs(_move_to_trash, path)
+        except OSError as e:
+            # Rename impossible (e.g. cross-device): delete in place, still off the loop
+            print(f"Trash Error ({path}): {e}")
+            target = path
+        if target is not None:
+            self._pending.append(target)
+            self._wakeup.set()
+
+    async def run(self):
+        # Leftovers from a previous run
+        if await fs_exists(TRASH_DIR):
+            self._pending.extend(await _fs(lambda: list(TRASH_DIR.iterdir())))
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            batch = [self._pending.popleft() for _ in range(min(self.batch, len(self._pending)))]
+            try: await _fs(_delete_trees, batch)
+            except Exception as e: print(f"Delete Error: {e}")
+
+TREE_DELETER = TreeDeleter()
+
+# ==============================================================================
+# --- DIAGNOSTICS: event-loop lag + blocked-loop stack dumps ---
+# ==============================================================================
+
+SLOW_CALLBACK_MS = int(os.environ.get("SLOW_CALLBACK_MS", "250"))
+
+class LoopMonitor:
+    """
+    Measures event-loop lag with a heartbeat every `interval`. A watchdog
+    thread notices when the heartbeat stalls for more than `threshold`
+    seconds and prints the loop thread's stack at that moment, i.e. the
+    callback that is blocking it (once per stall).
+    """
+    def __init__(self, interval=0.5, threshold=0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0      # EWMA, seconds
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - start - self.interval)
+            self.lag = 0.8 * self.lag + 0.2 * lag
+            self.max_lag = max(self.max_lag, lag)
+            M_LOOP_LAG.observe(lag)
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled > self.threshold and reported != beat:
+                reported = beat
+                self.stalls += 1
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+                print(f"⚠️ Event loop blocked for {stalled * 1000:.0f}ms at:\n{stack}")
+
+LOOP_MONITOR = LoopMonitor(threshold=SLOW_CALLBACK_MS / 1000)
+
+def _stale_task_folders(download_path, max_age):
+    """Task folders under downloads/<user>/ not modified for `max_age` seconds (runs on fs_executor)"""
+    if not download_path.exists(): return []
+    current_time = time.time()
+    stale = []
+    for user_folder in download_path.iterdir():
+        if user_folder.is_dir():
+            for task_folder in user_folder.iterdir():
+                if task_folder.is_dir() and (current_time - task_folder.stat().st_mtime) > max_age:
+                    stale.append(task_folder)
+    return stale
+
+async def cleanup_watchdog():
+    """Runs every 10 mins to clean stuck download folders older than 2 hours"""
+    while True:
+        await asyncio.sleep(600) # Check every 10 mins
+        try:
+            # 2 hours in seconds
+            max_age = 2 * 60 * 60 
+            for task_folder in await _fs(_stale_task_folders, Path("./downloads"), max_age):
+                await TREE_DELETER.discard(task_folder)
+                await send_log(f"🧹 **Auto-Cleanup:** Deleted stuck folder `{task_folder.name}` (Older than 2h)")
+        except Exception as e:
+            print(f"Watchdog Error: {e}")
+            
+async def start_task_final(client: Client, message_context: Message, task_data: dict, delay: int, user_id: int, task_uuid: str = None, resume_from: int = None):
+    # Several links in one submission: fan out into one task per link
+    if task_data.get("links"):
+        return await start_composite_job(client, message_context, task_data, delay, user_id)
+
     # 1. DISK SPACE PRE-CHECK
     if not await check_disk_space():
         msg = "⚠️ **Server Busy:** Disk is almost full. Please wait for other tasks to finish."
-        if isinstance(message_context, Message):
+        if task_uuid:
+            # Resumed from the journal: drop the entry, or it is re-resumed (and re-rejected) on every boot
+            msg += "\nThe interrupted task was dropped; send the link again later."
+        # A composite part is reported to its job, whose status message shows the rejection
+        await drop_task(client, task_data, task_uuid, cancelled=False)
+        if isinstance(message_context, Message) and not task_data.get("composite_id"):
              await message_context.reply(msg, quote=True)
         await send_log("🚨 **Critical:** Disk Space Low (<500MB). Tasks rejected.")
         return
 
-    # 2. QUEUE SYSTEM
-    # If user has hit their limit (e.g., 2 tasks), queue this one.
-    if user_id not in ADMINS and batch_temp.ACTIVE_TASKS[user_id] >= MAX_CONCURRENT_TASKS_PER_USER:
-        TASK_QUEUE[user_id].append({
-            "client": client,
-            "message": message_context,
-            "data": task_data,
-            "delay": delay
-        })
-        position = len(TASK_QUEUE[user_id])
-        await message_context.reply(f"⏳ **Added to Queue:** Position #{position}\nTask will start automatically when your current tasks finish.", quote=True)
+    # 2. JOURNAL (new tasks only; resumed tasks already have an entry)
+    if task_uuid is None:
+        task_uuid = uuid.uuid4().hex
+        try: await db.save_task(task_uuid, user_id, message_context.chat.id, task_data, delay)
+        except Exception as e: print(f"Task Journal Error: {e}")
+
+    # 3. QUEUE SYSTEM
+    # The scheduler starts the task now, or queues it fairly behind other users' work.
+    position = SCHEDULER.submit(
+        user_id,
+        lambda: launch_task(client, message_context, task_data, delay, user_id, task_uuid, resume_from),
+        on_drop=lambda: drop_task(client, task_data, task_uuid)
+    )
+    if position and not task_data.get("composite_id"):
+        await message_context.reply(f"⏳ **Added to Queue:** Position #{position}\nTask will start automatically when a slot frees up.", quote=True)
+
+async def launch_task(client: Client, message_context: Message, task_data: dict, delay: int, user_id: int, task_uuid: str, resume_from: int = None):
+    # 4. START TASK (Standard Logic) - called by SCHEDULER once a slot is granted
+    composite_id = task_data.get("composite_id")
+    if composite_id and CANCEL_FLAGS.get(composite_id):
+        # Its multi-link job was cancelled while this part waited
+        await drop_task(client, task_data, task_uuid)
+        SCHEDULER.finish(user_id)
         return
 
-    # 3. START TASK (Standard Logic)
-    task_uuid = uuid.uuid4().hex
     dest = task_data.get("dest_title", "Direct Message")
+    try: await db.set_task_status(task_uuid, "running")
+    except: pass
     
-    batch_temp.ACTIVE_TASKS[user_id] += 1
     batch_temp.IS_BATCH[user_id] = False
 
-    start_msg = f"✅ **Task Started!**\nDestination: `{dest}`\nSpeed: `{delay}s` delay\nTask ID: `{task_uuid[:8]}`"
+    speed_text = f"{delay}s delay" if delay else "Auto (adaptive)"
+    start_msg = f"✅ **Task Started!**\nDestination: `{dest}`\nSpeed: `{speed_text}`\nTask ID: `{task_uuid[:8]}`"
     try:
-        if isinstance(message_context, Message):
+        if isinstance(message_context, Message) and not task_data.get("composite_id"):
             if message_context.from_user.is_bot:
                 await message_context.edit(start_msg)
             else:
@@ -1260,12 +2725,129 @@ async def start_task_final(client: Client, message_context: Message, task_data:
             delay=delay,
             acc_user_id=user_id,
             task_uuid=task_uuid,
-            is_restricted=is_restricted # <--- PASS IT HERE
+            is_restricted=is_restricted, # <--- PASS IT HERE
+            resume_from=resume_from,
+            composite_id=task_data.get("composite_id")
         )
     )   
 
+async def drop_task(client: Client, task_data: dict, task_uuid: str = None, cancelled: bool = True):
+    """Cleans up a task that never ran (cancelled while queued, or rejected): journal entry and composite part."""
+    if task_uuid:
+        try: await db.delete_task(task_uuid)
+        except Exception as e: print(f"Task Journal Error: {e}")
+    composite = COMPOSITE_JOBS.get(task_data.get("composite_id"))
+    if composite:
+        await composite.part_finished(client, 0, 0, 0, cancelled, rejected=not cancelled)
+
+# ==============================================================================
+# --- COMPOSITE JOBS: many links / ranges submitted in one message ---
+# ==============================================================================
+
+COMPOSITE_JOBS = {}  # composite_id -> CompositeJob
+
+class CompositeJob:
+    """
+    One multi-link submission. Every link runs as its own scheduler task, so
+    their I/O interleaves with other work; parts report here instead of
+    posting their own summary, and a single status message is edited (at
+    most every PROGRESS_EDIT_INTERVAL seconds) until the last part ends.
+    """
+    def __init__(self, user_id, parts, dest_title):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.parts = parts
+        self.dest_title = dest_title
+        self.done = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.requested = 0
+        self.success = 0
+        self.failed = 0
+        self.started = time.time()
+        self.status_message = None
+        self._last_edit = 0.0
+
+    def text(self):
+        finished = self.done >= self.parts
+        title = "📦 **Multi-Link Job Completed!** ✨" if finished else "📦 **Multi-Link Job Running...**"
+        text = (
+            f"{title}\n\n"
+            f"**Destination:** `{self.dest_title}`\n"
+            f"**Links:** `{self.done}` / `{self.parts}` done\n"
+            f"**Messages:** `{self.requested}` requested so far\n"
+            f"**Successfully Saved:** `{self.success}`\n"
+            f"**Failed/Skipped:** `{self.failed}`"
+        )
+        if self.cancelled:
+            text += f"\n**Cancelled Links:** `{self.cancelled}` 🛑"
+        if self.rejected:
+            text += f"\n**Rejected Links (disk full):** `{self.rejected}` ⚠️"
+        if finished:
+            text += f"\n**Time:** `{get_readable_time(int(time.time() - self.started))}`"
+        return text
+
+    async def part_finished(self, client, success, failed, total, cancelled, rejected=False):
+        self.done += 1
+        self.success += success
+        self.failed += failed
+        self.requested += total
+        if cancelled: self.cancelled += 1
+        if rejected: self.rejected += 1
+        finished = self.done >= self.parts
+        if finished:
+            COMPOSITE_JOBS.pop(self.id, None)
+            CANCEL_FLAGS.pop(self.id, None)
+        elif time.time() - self._last_edit < PROGRESS_EDIT_INTERVAL:
+            return
+        self._last_edit = time.time()
+        try: await self.status_message.edit_text(self.text())
+        except Exception: pass
+
+async def start_composite_job(client: Client, message_context: Message, task_data: dict, delay: int, user_id: int):
+    links = task_data["links"]
+    restricted = task_data.get("restricted", {})
+    job = CompositeJob(user_id, len(links), task_data.get("dest_title", "Direct Message"))
+    job.status_message = await client.send_message(
+        message_context.chat.id,
+        f"📦 **Multi-Link Job:** `{len(links)}` links queued\nTask ID: `{job.id[:8]}`"
+    )
+    COMPOSITE_JOBS[job.id] = job
+    for url in links:
+        if CANCEL_FLAGS.get(job.id):
+            # Cancelled while the parts were still being submitted
+            await job.part_finished(client, 0, 0, 0, True)
+            continue
+        part = {k: v for k, v in task_data.items() if k not in ("links", "restricted")}
+        part.update(link=url, is_restricted=restricted.get(url, task_data.get("is_restricted", False)), composite_id=job.id)
+        # Parts reply under the composite's status message instead of the (deleted) menu
+        await start_task_final(client, job.status_message, part, delay, user_id)
+
+async def resume_unfinished_tasks(client: Client):
+    """On boot, re-submits every journaled task, continuing after its last checkpoint."""
+    try:
+        cursor = await db.get_unfinished_tasks()
+        jobs = [job async for job in cursor]
+    except Exception as e:
+        print(f"Task Journal Error: {e}")
+        return
+
+    for job in jobs:
+        try:
+            resume_from = job["last_msg_id"] + 1 if job.get("last_msg_id") else None
+            note = f" from message `{resume_from}`" if resume_from else ""
+            context = await client.send_message(job["origin_chat_id"], f"♻️ **Resuming interrupted task**{note}\n`{job['link'][:60]}`")
+            task_data = {k: job.get(k) for k in ("link", "dest_chat_id", "dest_thread_id", "dest_title", "is_restricted")}
+            await start_task_final(client, context, task_data, job.get("delay", 3), job["user_id"], task_uuid=job["_id"], resume_from=resume_from)
+        except Exception as e:
+            print(f"Resume Error ({job.get('_id')}): {e}")
+            try: await db.delete_task(job["_id"])
+            except: pass
+    if jobs:
+        print(f"♻️ Resumed {len(jobs)} interrupted task(s)")
+
 # CHANGE: Added is_restricted=False argument
-async def process_links_logic(client: Client, message: Message, text: str, dest_chat_id=None, dest_thread_id=None, delay=3, acc_user_id=None, task_uuid=None, is_restricted=False):
+async def process_links_logic(client: Client, message: Message, text: str, dest_chat_id=None, dest_thread_id=None, delay=3, acc_user_id=None, task_uuid=None, is_restricted=False, resume_from=None, composite_id=None):
     # --- 1. SETUP USER & LOGGING ---
     if acc_user_id:
         user_id = acc_user_id
@@ -1298,6 +2880,9 @@ async def process_links_logic(client: Client, message: Message, text: str, dest_
     # --- 3. BATCH PROCESSING ---
     if "https://t.me/" in text:
         acc = None
+        prefetcher = None
+        pipeline = set()
+        interrupted = False
         success_count = 0
         failed_count = 0
         total_count = 0
@@ -1306,33 +2891,27 @@ async def process_links_logic(client: Client, message: Message, text: str, dest_
 
         try:
             was_cancelled = False
-            clean_text = text.replace("https://", "").replace("http://", "").replace("t.me/", "").replace("c/", "")
-            parts = clean_text.split("/")
-
-            if len(parts) >= 3 and parts[1].isdigit(): filter_thread_id = int(parts[1])
-
-            try:
-                last_segment = parts[-1].strip()
-                if "-" in text:
-                    range_match = re.search(r"(\d+)\s*-\s*(\d+)", text)
-                    if range_match:
-                        fromID = int(range_match.group(1))
-                        toID = int(range_match.group(2))
-                    else:
-                        fromID = int(last_segment); toID = fromID
-                else:
-                    fromID = int(last_segment); toID = fromID
-            except Exception as e:
-                await message.reply_text(f"**Link Error:** `{e}`")
+            link = parse_link(text)
+            if link is None or link.kind == "invite":
+                await message.reply_text("**Link Error:** `Format not recognized`")
                 raise ValueError("Link parse error")
 
+            chatid = link.chat
+            filter_thread_id = link.topic_id
+            fromID, toID = link.from_id, link.to_id
+
             if filter_thread_id and fromID < filter_thread_id:
                 fromID = filter_thread_id
 
-            datas = text.split("/")
+            # Resumed from the task journal: skip what was already done before the restart
+            if resume_from and resume_from > fromID:
+                fromID = resume_from
+
             total_count = max(1, toID - fromID + 1)
 
             status_text_header = f"**Batch Task Started!** 🚀\n"
+            if resume_from:
+                status_text_header += f"**Resumed:** `from {fromID}` ♻️\n"
             if filter_thread_id:
                 status_text_header += f"**Filter:** `Topic {filter_thread_id} Only` 🎯\n"
 
@@ -1352,64 +2931,149 @@ async def process_links_logic(client: Client, message: Message, text: str, dest_
                 user_data = await db.get_session(user_id)
                 if user_data is None:
                     await message.reply("**/login First.**"); raise ValueError("Not logged in")
-                api_id = await db.get_api_id(user_id)
-                api_hash = await db.get_api_hash(user_id)
                 try:
-                    acc = Client(":memory:", session_string=user_data, api_hash=api_hash, api_id=api_id, no_updates=True)
-                    await acc.connect()
+                    acc = await USER_CLIENTS.acquire(user_id)
                 except Exception as e:
                     await message.reply(f"**Login Failed:** `{e}`"); raise ValueError("Login failed")
             else:
                 if GlobalUserSession is None: raise ValueError("Global Session Missing")
                 acc = GlobalUserSession
 
-            # --- LOOP START ---
+            # Fresher than the flag stored with the task (e.g. resumed after a restart)
+            caps = CHAT_CAPS.get(user_account(user_id), chatid)
+            if caps is not None: is_restricted = not caps.forwardable
+
+            # --- FETCH: streamed pre-scan (only ids that exist, topic filtered server-side),
+            # or bulk get_messages over every id of the range (200 ids per call) ---
+            prefetch_queue = asyncio.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+            scan = None
+            if RANGE_PRESCAN and toID > fromID:
+                scan = {}
+                prefetcher = asyncio.create_task(scan_messages(acc, chatid, fromID, toID, prefetch_queue, filter_thread_id, user_id, task_uuid, scan))
+            else:
+                prefetcher = asyncio.create_task(prefetch_messages(acc, chatid, range(fromID, toID + 1), prefetch_queue, user_id, task_uuid))
+
+            # --- PIPELINE START: prefetcher -> PIPELINE_DEPTH units downloading -> in-order delivery ---
             start_time = time.time()
             last_update_time = start_time
+            last_status_count = 0
+            last_checkpoint_count = 0
+            last_checkpoint_id = None
+            flood_abort = 0
+            index = 0
+            order = DeliveryOrder()
+            window = asyncio.Semaphore(PIPELINE_DEPTH)
+
+            async def unit_failed(e):
+                nonlocal was_cancelled, flood_abort
+                if isinstance(e, AuthKeyUnregistered):
+                    if not was_cancelled:
+                        was_cancelled = True
+                        await USER_CLIENTS.invalidate(user_id, acc)
+                        await client.send_message(message.chat.id, "❌ **Session Expired.** Please /logout and /login again.")
+                elif isinstance(e, FloodWait):
+                    # Already counted in M_FLOODWAIT where it was raised (RATE_LIMITER.flood / prefetch)
+                    print(f"FloodWait in Loop: {e.value}s")
+                    if e.value > 120: flood_abort = max(flood_abort, e.value)
+                    else: order.pause(e.value + 5)  # Hold deliveries; downloads keep going
+                else:
+                    print(f"Loop Error: {e}")
 
-            for index, msgid in enumerate(range(fromID, toID+1), start=1):
-                # 1. Start Timer for this specific message
-                step_start_time = time.time()
-
-                # Check Cancellation
-                if batch_temp.IS_BATCH.get(user_id) or CANCEL_FLAGS.get(task_uuid):
-                    was_cancelled = True; break
-
-                is_success = False
+            async def run_unit(item, key, index):
+                # One message (or one bulk-forward batch): downloads right away, delivers on its turn
+                nonlocal success_count, failed_count
+                batch = item if isinstance(item, list) else [item]
+                turn = lambda: order.wait_turn(key)
+                done_count = 0
                 try:
-                    # Chat ID Setup
-                    if "https://t.me/c/" in text:
-                        chatid = int("-100" + parts[0])
-                        if not parts[0].isdigit(): chatid = int("-100" + datas[4])
+                    if isinstance(item, list):
+                        msgs = [m for _, m in batch if m is not None]
+                        await turn()
+                        with M_STAGE.time(stage="forward"):
+                            forwarded = await forward_batch(acc, chatid, msgs, dest_chat_id, dest_thread_id, user_id)
+                        if forwarded:
+                            done_count = len(msgs)
+                        else:
+                            # Batch rejected: fall back to one-by-one copy/download (still our turn)
+                            for m in msgs:
+                                if batch_temp.IS_BATCH.get(user_id) or CANCEL_FLAGS.get(task_uuid) or CANCEL_FLAGS.get(composite_id): break
+                                if await handle_private(client, acc, message, chatid, m.id, index, total_count, status_message, dest_chat_id, dest_thread_id, delay, user_id, task_uuid, msg=m):
+                                    done_count += 1
                     else:
-                        chatid = parts[0]
-
-                    # --- PROCESSING ---
-                    # Returns True when upload is totally done
-                    is_success = await handle_private(client, acc, message, chatid, msgid, index, total_count, status_message, dest_chat_id, dest_thread_id, delay, user_id, task_uuid)
-
-                except FloodWait as e:
-                    print(f"FloodWait in Loop: {e.value}s")
-                    if e.value > 120:
-                        await client.send_message(message.chat.id, f"🚨 **FloodWait Too Long ({e.value}s). Task Aborted.**")
-                        return
-                    await asyncio.sleep(e.value + 5)
-                    is_success = False
+                        if await handle_private(client, acc, message, chatid, key, index, total_count, status_message, dest_chat_id, dest_thread_id, delay, user_id, task_uuid, msg=item[1], turn=turn):
+                            done_count = 1
                 except Exception as e:
-                    print(f"Loop Error: {e}")
-                    is_success = False
-
-                if is_success: success_count += 1
-                else: failed_count += 1
+                    await unit_failed(e)
+                finally:
+                    success_count += done_count
+                    failed_count += len(batch) - done_count
+                    M_MESSAGES.inc(done_count, result="success")
+                    M_MESSAGES.inc(len(batch) - done_count, result="failed")
+
+                    # --- PACING (RESTRICTION BASED) ---
+                    # delay == 0 (Auto): RATE_LIMITER already paces every send, no fixed pause.
+                    # The pause only holds the next delivery; later downloads carry on meanwhile.
+                    if done_count and delay:
+                        if is_restricted:
+                            # 🔒 Cool the account down for the FULL delay after an upload
+                            order.pause(delay)
+                        else:
+                            # 🔓 Strict pace: delivery start to next delivery start = delay
+                            order.pause(delay - (time.monotonic() - order.turn_started))
+                    await order.finish(key)
+                    window.release()
+
+            # Unrestricted sources: runs of forwardable messages arrive as one list (bulk forward)
+            async for item in group_forward_batches(prefetch_queue, enabled=not is_restricted):
+                # Check Cancellation (the task, or its whole multi-link job)
+                if batch_temp.IS_BATCH.get(user_id) or CANCEL_FLAGS.get(task_uuid) or CANCEL_FLAGS.get(composite_id):
+                    was_cancelled = True
+                if was_cancelled or flood_abort: break
+
+                if isinstance(item, BaseException):
+                    # Fatal prefetch error; the sentinel follows
+                    await unit_failed(item)
+                    failed_count += 1
+                    M_MESSAGES.inc(result="failed")
+                    continue
+
+                batch = item if isinstance(item, list) else [item]
+                index += len(batch)
+                msgid = batch[-1][0]
+                order.register(msgid)
+                if not isinstance(item, list) and item[1] is None:
+                    # Deleted / empty / unsupported: nothing to deliver
+                    failed_count += 1
+                    M_MESSAGES.inc(result="failed")
+                    await order.finish(msgid)
+                else:
+                    await window.acquire()
+                    unit = asyncio.create_task(run_unit(item, msgid, index))
+                    pipeline.add(unit)
+                    unit.add_done_callback(pipeline.discard)
+
+                processed = success_count + failed_count
+                if scan is not None:
+                    # Streamed pre-scan: exact once it ends, extrapolated from the scanned share of the range until then
+                    scanned = scan["cursor"] - fromID + 1
+                    total_count = scan["found"] if scan["done"] or scanned <= 0 else max(scan["found"], round(scan["found"] * (toID - fromID + 1) / scanned))
+
+                # --- CHECKPOINT (task journal): highest id with everything before it delivered ---
+                if processed - last_checkpoint_count >= TASK_CHECKPOINT_EVERY and order.delivered_upto != last_checkpoint_id:
+                    last_checkpoint_count = processed
+                    last_checkpoint_id = order.delivered_upto
+                    try: await db.checkpoint_task(task_uuid, last_checkpoint_id)
+                    except Exception as e: print(f"Checkpoint Error: {e}")
 
                 # --- STATUS UPDATE ---
                 current_time = time.time()
-                if (index % 20 == 0) or ((current_time - last_update_time) > 60):
+                if (processed - last_status_count >= 20) or ((current_time - last_update_time) > 60):
+                    last_status_count = processed
                     last_update_time = current_time
                     elapsed_time = current_time - start_time
-                    if elapsed_time > 0:
-                        items_per_second = index / elapsed_time
-                        items_remaining = total_count - index
+                    if elapsed_time > 0 and processed:
+                        items_per_second = processed / elapsed_time
+                        items_remaining = total_count - processed
                         eta_seconds = items_remaining / items_per_second if items_per_second > 0 else 0
                         eta_str = get_readable_time(int(eta_seconds))
                     else:
@@ -1418,56 +3082,67 @@ async def process_links_logic(client: Client, message: Message, text: str, dest_
                     try:
                         await status_message.edit_text(
                             f"{status_text_header}\n"
-                            f"**Total:** `{total_count}`\n"
-                            f"**Processed:** `{index}`\n"
+                            f"**Total:** `{total_count}`{' (scanning...)' if scan is not None and not scan['done'] else ''}\n"
+                            f"**Processed:** `{processed}`\n"
                             f"**Success:** `{success_count}`\n"
                             f"**Failed/Skipped:** `{failed_count}`\n"
                             f"**ETA:** `{eta_str}`"
                         )
                     except: pass
 
-                # --- HYBRID SLEEP SYSTEM (RESTRICTION BASED) ---
-                if is_success:
-                    if is_restricted:
-                        # 🔒 RESTRICTED MODE (Downloads/Uploads)
-                        # We need to cool down the account after heavy upload.
-                        # Logic: Wait the FULL delay.
-                        await asyncio.sleep(delay)
-                    else:
-                        # 🔓 PUBLIC MODE (Forwarding)
-                        # Fast operation. maintain strict pace.
-                        # Logic: Total Time (Process + Sleep) = Delay.
-                        time_taken = time.time() - step_start_time
-                        sleep_time = max(0, delay - time_taken)
-                        await asyncio.sleep(sleep_time)
-                else:
-                # If failed/deleted, skip faster (only 0.1s delay)
-                    await asyncio.sleep(0.1)
+            # --- DRAIN: let in-flight units deliver, or drop them on cancel/abort ---
+            if was_cancelled or flood_abort:
+                for unit in list(pipeline): unit.cancel()
+            if pipeline:
+                await asyncio.gather(*pipeline, return_exceptions=True)
+            if scan is not None and scan["done"]:
+                total_count = scan["found"]
+            if batch_temp.IS_BATCH.get(user_id) or CANCEL_FLAGS.get(task_uuid) or CANCEL_FLAGS.get(composite_id):
+                was_cancelled = True
+            if flood_abort:
+                await client.send_message(message.chat.id, f"🚨 **FloodWait Too Long ({flood_abort}s). Task Aborted.**")
+                return
+
+        except asyncio.CancelledError:
+            # Shutdown/restart: keep the journal entry so the task resumes on boot
+            interrupted = True
+            raise
 
         except Exception as e:
             print(f"Critical Task Error: {e}")
             await send_log(f"❌ **Task Crashed**\nUser: `{acc_user_id}`\nError: `{e}`")
 
         finally:
+            if prefetcher and not prefetcher.done():
+                prefetcher.cancel()
+            for unit in list(pipeline): unit.cancel()
+            if status_message:
+                # Units clear their own msg_id folders; drop the (now empty) task folder too
+                try: await TREE_DELETER.discard(Path(f"./downloads/{user_id}/{status_message.id}/"))
+                except: pass
+
+            if not interrupted:
+                try: await db.delete_task(task_uuid)
+                except: pass
+
             if task_uuid in ACTIVE_PROCESSES.get(acc_user_id, {}):
                 try: del ACTIVE_PROCESSES[acc_user_id][task_uuid]
                 except: pass
             
-            batch_temp.ACTIVE_TASKS[acc_user_id] -= 1
-            if batch_temp.ACTIVE_TASKS[acc_user_id] <= 0:
-                batch_temp.ACTIVE_TASKS[acc_user_id] = 0
+            SCHEDULER.finish(acc_user_id)
+            if SCHEDULER.running(acc_user_id) <= 0:
                 batch_temp.IS_BATCH[acc_user_id] = False
 
-            if TASK_QUEUE[acc_user_id]:
-                next_item = TASK_QUEUE[acc_user_id].pop(0)
-                asyncio.create_task(start_task_final(next_item["client"], next_item["message"], next_item["data"], next_item["delay"], acc_user_id))
-
             if LOGIN_SYSTEM == True and acc:
-                try: await acc.stop()
-                except: pass
+                await USER_CLIENTS.release(user_id, acc)
 
             # --- COMPLETION / CANCEL MESSAGE FIX ---
-            if 'was_cancelled' in locals() and was_cancelled:
+            composite = COMPOSITE_JOBS.get(composite_id) if composite_id else None
+            if composite:
+                # Part of a multi-link job: the composite posts one summary for all parts
+                final_text = None
+                await composite.part_finished(client, success_count, failed_count, total_count, 'was_cancelled' in locals() and was_cancelled)
+            elif 'was_cancelled' in locals() and was_cancelled:
                 final_text = (
                     f"**Batch was Cancelled!** 🛑 {user_mention}\n\n"
                     f"**Total Requested:** `{total_count}`\n"
@@ -1482,21 +3157,877 @@ async def process_links_logic(client: Client, message: Message, text: str, dest_
                     f"**Failed/Skipped:** `{failed_count}`"
                 )
             
-            try: await client.send_message(message.chat.id, final_text, reply_to_message_id=message.id)
-            except: pass
+            if final_text:
+                try: await client.send_message(message.chat.id, final_text, reply_to_message_id=message.id)
+                except: pass
             try: await status_message.delete()
             except: pass
 
 # ==============================================================================
-# --- handle_private: downloads & uploads with per-task cancel checks ---
+# --- PREFETCH: bulk message fetch feeding the batch loop ---
+# ==============================================================================
+
+PREFETCH_CHUNK = 200  # get_messages accepts up to 200 ids per call
+PREFETCH_QUEUE_SIZE = PREFETCH_CHUNK * 2
+PREFETCH_RETRIES = 4  # tries per full chunk, with 1s/2s/4s backoff in between
+PREFETCH_SPLIT_BUDGET = 16  # failed sub-chunk calls allowed before the rest become gaps
+
+async def _get_messages_retry(acc, chatid, ids, attempts):
+    """get_messages with FloodWait handling and exponential backoff on other errors; re-raises the last one."""
+    failures = 0
+    while True:
+        try:
+            with M_STAGE.time(stage="fetch"):
+                return await acc.get_messages(chatid, ids)
+        except FloodWait as e:
+            M_FLOODWAIT.inc(e.value, method="get_messages")
+            if e.value > 120: raise
+            await asyncio.sleep(e.value + 5)
+        except (AuthKeyUnregistered, UserDeactivated): raise
+        except Exception as e:
+            failures += 1
+            print(f"Prefetch Error ({chatid} {ids[0]}-{ids[-1]}, try {failures}/{attempts}): {e}")
+            if failures >= attempts: raise
+            await asyncio.sleep(2 ** (failures - 1))
+
+async def fetch_messages_chunk(acc, chatid, ids, attempts=PREFETCH_RETRIES, budget=None):
+    """
+    Messages for `ids`. A chunk that still fails after its retries is split
+    in halves (one try each) down to single ids, so a transient error or one
+    bad id costs only the ids that really cannot be fetched. `budget` caps the
+    failed calls per chunk so a dead connection is not hammered id by id.
+    """
+    if budget is None: budget = [PREFETCH_SPLIT_BUDGET]
+    try:
+        return list(await _get_messages_retry(acc, chatid, ids, attempts) or [])
+    except (FloodWait, AuthKeyUnregistered, UserDeactivated): raise
+    except Exception as e:
+        budget[0] -= 1
+        if len(ids) == 1 or budget[0] <= 0:
+            print(f"Prefetch: giving up on {chatid} {ids[0]}-{ids[-1]} ({len(ids)} ids): {e}")
+            return []
+    half = len(ids) // 2
+    return (await fetch_messages_chunk(acc, chatid, ids[:half], 1, budget)) + (await fetch_messages_chunk(acc, chatid, ids[half:], 1, budget))
+
+async def prefetch_messages(acc, chatid, msg_ids, queue: asyncio.Queue, user_id=None, task_uuid=None):
+    """
+    Producer for process_links_logic. Fetches msg_ids (ascending; a range or
+    the pre-scanned list) in chunks of 200 and puts (msgid, msg) on the queue
+    in order; msg is None for deleted, empty or unsupported messages (or ids
+    that kept failing, see fetch_messages_chunk). Fatal errors are queued as
+    the exception object. Always ends with a None sentinel.
+    """
+    try:
+        for start in range(0, len(msg_ids), PREFETCH_CHUNK):
+            if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): break
+            ids = list(msg_ids[start:start + PREFETCH_CHUNK])
+            msgs = await fetch_messages_chunk(acc, chatid, ids)
+
+            found = {m.id: m for m in msgs if m and not m.empty and get_message_type(m)}
+            for mid in ids:
+                await queue.put((mid, found.get(mid)))
+    except Exception as e:
+        await queue.put(e)
+    await queue.put(None)
+
+# ==============================================================================
+# --- RANGE PRE-SCAN: enumerate the ids that actually exist ---
 # ==============================================================================
 
-async def handle_private(client: Client, acc, message: Message, chatid, msgid: int, index: int, total_count: int, status_message: Message, dest_chat_id, dest_thread_id, delay, user_id, task_uuid=None):
-    msg = None
+RANGE_PRESCAN = os.environ.get("RANGE_PRESCAN", "True").lower() == "true"
+PRESCAN_PAGE = 100  # messages.getHistory / getReplies page size
+
+async def scan_messages(acc, chatid, fromID: int, toID: int, queue: asyncio.Queue, topic_id=None, user_id=None, task_uuid=None, scan=None):
+    """
+    Producer for process_links_logic, used instead of prefetch_messages when
+    RANGE_PRESCAN is on. Pages forward through [fromID, toID] with
+    messages.getHistory, or messages.getReplies when topic_id is set so the
+    server drops messages of other topics. The parsed messages of each page
+    go straight onto the queue as (msgid, msg), ascending, while the next
+    page is read; ids that do not exist never reach the batch loop.
+    `scan` (a dict) is kept up to date with cursor/found/done for the status
+    message. On a non-fatal error the rest of the range is handed to
+    prefetch_messages. Fatal errors are queued as the exception object.
+    Always ends with a None sentinel.
+    """
+    scan = scan if scan is not None else {}
+    scan.update(cursor=fromID - 1, found=0, done=False)
     try:
-        msg = await acc.get_messages(chatid, msgid)
-    except UserNotParticipant: return False
-    except Exception: return False
+        peer = await acc.resolve_peer(chatid)
+        while scan["cursor"] < toID:
+            if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): break
+            cursor = scan["cursor"]
+            # add_offset=-limit makes offset_id an inclusive lower bound: the page right above cursor
+            page = dict(peer=peer, offset_id=cursor + 1, offset_date=0, add_offset=-PRESCAN_PAGE, limit=PRESCAN_PAGE, max_id=toID + 1, min_id=cursor, hash=0)
+            try:
+                with M_STAGE.time(stage="prescan"):
+                    if topic_id:
+                        result = await acc.invoke(raw.functions.messages.GetReplies(msg_id=topic_id, **page))
+                    else:
+                        result = await acc.invoke(raw.functions.messages.GetHistory(**page))
+            except FloodWait as e:
+                M_FLOODWAIT.inc(e.value, method="prescan")
+                if e.value > 120: raise
+                await asyncio.sleep(e.value + 5)
+                continue
+            except (AuthKeyUnregistered, UserDeactivated): raise
+            except Exception as e:
+                # Walk the rest of the range id by id instead
+                print(f"Pre-scan failed ({chatid} {cursor + 1}-{toID}): {e}")
+                scan.update(found=scan["found"] + toID - cursor, done=True)
+                await prefetch_messages(acc, chatid, range(cursor + 1, toID + 1), queue, user_id, task_uuid)
+                return
+
+            messages = await utils.parse_messages(acc, result, replies=0)
+            fresh = sorted((m for m in messages if cursor < m.id <= toID), key=lambda m: m.id)
+            if not fresh: break
+            for m in fresh:
+                if not m.empty and get_message_type(m):  # Service messages have no type
+                    scan["found"] += 1
+                    await queue.put((m.id, m))
+            scan["cursor"] = fresh[-1].id
+    except Exception as e:
+        await queue.put(e)
+    scan["done"] = True
+    await queue.put(None)
+
+# ==============================================================================
+# --- BULK FORWARD: forward_messages fast path for unrestricted ranges ---
+# ==============================================================================
+
+FORWARD_BATCH_SIZE = 100  # forward_messages accepts up to 100 ids per call
+
+def _is_forwardable(item):
+    if item is None or isinstance(item, BaseException) or item[1] is None:
+        return False
+    msg = item[1]
+    return not getattr(msg.chat, "has_protected_content", False) and not getattr(msg, "has_protected_content", False)
+
+async def group_forward_batches(queue: asyncio.Queue, enabled: bool = True):
+    """
+    Async generator over prefetched items. With `enabled`, runs of forwardable
+    messages (gaps included) are yielded as one list holding up to
+    FORWARD_BATCH_SIZE messages; a batch never ends mid-album, neither when it
+    is full nor when the prefetcher has not queued the rest yet. Anything else
+    is yielded unchanged. Stops at the None sentinel.
+    """
+    pending = deque()
+    while True:
+        item = pending.popleft() if pending else await queue.get()
+        if item is None: return
+        if not enabled or not _is_forwardable(item):
+            yield item
+            continue
+
+        batch = [item]
+        count = 1
+        while count < FORWARD_BATCH_SIZE:
+            if pending: nxt = pending.popleft()
+            else:
+                try: nxt = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    # Prefetch chunk boundary: the last album may go on in the next chunk
+                    if _carry_album_tail(batch, pending): break
+                    if not _album_tail_id(batch): break
+                    nxt = await queue.get()  # The batch is that one album: wait for the rest of it
+            if nxt is None or isinstance(nxt, BaseException) or (nxt[1] is not None and not _is_forwardable(nxt)):
+                pending.appendleft(nxt)
+                break
+            batch.append(nxt)
+            if nxt[1] is not None: count += 1
+
+        # A full batch may have cut an album short: carry its trailing members into the next one
+        if count >= FORWARD_BATCH_SIZE:
+            _carry_album_tail(batch, pending)
+        yield batch
+
+def _album_tail_id(batch):
+    return next((m.media_group_id for _, m in reversed(batch) if m is not None), None)
+
+def _carry_album_tail(batch, pending) -> bool:
+    """
+    Moves the members of the album `batch` ends in (and gaps after them) back
+    onto `pending`. Nothing moves if the batch does not end in an album or is
+    that album alone. Returns True if something moved.
+    """
+    group_id = _album_tail_id(batch)
+    if not group_id or batch[0][1].media_group_id == group_id:
+        return False
+    while batch[-1][1] is None or batch[-1][1].media_group_id == group_id:
+        pending.appendleft(batch.pop())
+    return True
+
+async def forward_batch(acc, chatid, msgs, dest_chat_id, dest_thread_id, user_id) -> bool:
+    """
+    Forwards `msgs` in one forward_messages call without the author header.
+    Waits out FloodWaits up to 120s; returns False if the call is rejected so
+    the caller can fall back to per-message copy.
+    """
+    if not msgs:
+        return True
+    key = rate_key(user_account(user_id), dest_chat_id, "forward")
+    while True:
+        # Token first: a bucket blocked by FloodWait waits without holding a forward slot
+        await RATE_LIMITER.acquire(key)
+        try:
+            async with SCHEDULER.slot("forward", user_id):
+                await acc.forward_messages(
+                    chat_id=dest_chat_id,
+                    from_chat_id=chatid,
+                    message_ids=[m.id for m in msgs],
+                    message_thread_id=dest_thread_id,
+                    drop_author=True
+                )
+            RATE_LIMITER.success(key)
+            return True
+        except FloodWait as e:
+            RATE_LIMITER.flood(key, e.value)
+            if e.value > 120: raise
+        except (AuthKeyUnregistered, UserDeactivated): raise
+        except Exception as e:
+            print(f"Bulk forward rejected ({len(msgs)} msgs): {e}")
+            return False
+
+# ==============================================================================
+# --- PIPELINE: downloads run ahead, deliveries leave in message order ---
+# ==============================================================================
+
+PIPELINE_DEPTH = max(1, int(os.environ.get("PIPELINE_DEPTH", "3")))  # Messages in flight per batch task
+
+async def _no_turn():
+    pass
+
+class DeliveryOrder:
+    """
+    Reorder buffer for one batch task, keyed by msg_id. Units register in
+    source order and may download concurrently, but wait_turn() only returns
+    for the oldest unfinished unit, and not before the pacing set by pause().
+    delivered_upto is the highest msg_id with everything before it finished
+    (what the task journal may checkpoint).
+    """
+    def __init__(self):
+        self._order = deque()
+        self._finished = set()
+        self._cond = asyncio.Condition()
+        self._turn_key = None
+        self.next_allowed = 0.0
+        self.turn_started = 0.0
+        self.delivered_upto = None
+
+    def register(self, key):
+        self._order.append(key)
+
+    async def wait_turn(self, key):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._order and self._order[0] == key)
+        while time.monotonic() < self.next_allowed:
+            await asyncio.sleep(self.next_allowed - time.monotonic())
+        if self._turn_key != key:
+            self._turn_key = key
+            self.turn_started = time.monotonic()
+
+    def pause(self, seconds):
+        """Holds the next delivery for `seconds` (delay pacing, FloodWait)."""
+        if seconds > 0:
+            self.next_allowed = max(self.next_allowed, time.monotonic() + seconds)
+
+    async def finish(self, key):
+        async with self._cond:
+            self._finished.add(key)
+            while self._order and self._order[0] in self._finished:
+                self.delivered_upto = self._order.popleft()
+                self._finished.discard(self.delivered_upto)
+            self._cond.notify_all()
+
+# ==============================================================================
+# --- STREAMING TRANSFER: download -> upload without touching disk ---
+# ==============================================================================
+
+STREAM_PART_SIZE = 512 * 1024  # Telegram upload part size
+STREAM_BIG_FILE = 10 * 1024 * 1024  # Files above this must use saveBigFilePart
+STREAM_MAX_SIZE = 2000 * 1024 * 1024  # Bot upload limit; larger files take the split path
+
+def _thread_reply_to(thread_id):
+    if not thread_id:
+        return None
+    return raw.types.InputReplyToMessage(reply_to_msg_id=thread_id, top_msg_id=thread_id)
+
+async def stream_upload(client: Client, acc, msg: Message, status_message: Message, task_uuid=None, refresh=None):
+    """
+    Pipes the chunks of `msg` straight into upload parts on media sessions of
+    `client` (never its main connection, which carries every user's updates).
+    From PARALLEL_DOWNLOAD_MIN_SIZE / PARALLEL_UPLOAD_MIN_SIZE up, the chunks
+    come from parallel_stream_media() and the parts are spread across
+    UPLOAD_CONNECTIONS sessions. Chunks pass through a bounded queue
+    (STREAM_BUFFER_CHUNKS MB), so download and upload overlap and nothing is
+    written to disk. Nothing is sent: returns (input_file, file_name) for
+    send_uploaded_media(), so the transfer can run ahead of the unit's
+    delivery turn.
+    """
+    media = msg.document or msg.video or msg.audio
+    file_size = media.file_size
+    file_name = sanitize_filename(getattr(media, "file_name", None) or f"{msg.id}.dat")
+    is_big = file_size > STREAM_BIG_FILE
+    total_parts = max(1, -(-file_size // STREAM_PART_SIZE))
+    file_id = client.rnd_id()
+    buffer = asyncio.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+    connections = min(UPLOAD_CONNECTIONS, total_parts) if file_size >= PARALLEL_UPLOAD_MIN_SIZE else 1
+    parts = asyncio.Queue(maxsize=max(1, connections))
+    state = {"received": 0, "uploaded": 0, "error": None, "broken": False}
+
+    async def pump(chunks):
+        async for chunk in chunks:
+            state["received"] += len(chunk)
+            progress(state["received"], file_size, status_message, "down", task_uuid)
+            await buffer.put(chunk)
+
+    async def reader():
+        try:
+            if DOWNLOAD_CONNECTIONS > 1 and file_size >= PARALLEL_DOWNLOAD_MIN_SIZE:
+                try:
+                    await pump(parallel_stream_media(acc, msg, file_size, refresh=refresh))
+                    return
+                except FloodWait: raise
+                except Exception as e:
+                    # Only before the first byte: the parts already queued can't be replayed
+                    if state["received"] or "CANCELLED" in str(e): raise
+                    print(f"Parallel stream download failed, using single connection: {e}")
+            await pump(acc.stream_media(msg))
+        finally:
+            await buffer.put(None)
+
+    async def uploader(session):
+        # After the first error keeps draining, so the producer never blocks on a full queue
+        while True:
+            item = await parts.get()
+            if item is None: return
+            if state["error"]: continue
+            part_no, data = item
+            if is_big:
+                request = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=part_no, file_total_parts=total_parts, bytes=data)
+            else:
+                request = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part_no, bytes=data)
+            try:
+                while True:
+                    try:
+                        await session.invoke(request)
+                        break
+                    except FloodWait as e:
+                        await asyncio.sleep(e.value + 1)
+                    except Exception:
+                        state["broken"] = True
+                        raise
+                state["uploaded"] += len(data)
+                progress(state["uploaded"], file_size, status_message, "up", task_uuid)
+            except Exception as e:
+                state["error"] = e
+
+    dc_id = await client.storage.dc_id()
+    sessions = await MEDIA_SESSIONS.acquire(client, dc_id, connections)
+    reader_task = asyncio.create_task(reader())
+    workers = [asyncio.create_task(uploader(session)) for session in sessions]
+    try:
+        part_no = 0
+        pending = bytearray()
+        while not state["error"]:
+            chunk = await buffer.get()
+            if chunk is None: break
+            pending.extend(chunk)
+            while len(pending) >= STREAM_PART_SIZE:
+                await parts.put((part_no, bytes(pending[:STREAM_PART_SIZE])))
+                del pending[:STREAM_PART_SIZE]
+                part_no += 1
+        if pending and not state["error"]:
+            await parts.put((part_no, bytes(pending)))
+            part_no += 1
+        for _ in workers:
+            await parts.put(None)
+        await asyncio.gather(*workers)
+        if state["error"]: raise state["error"]
+        await reader_task  # Surface download errors (FileReferenceExpired, cancel, ...)
+        if part_no != total_parts:
+            raise Exception(f"STREAM_INCOMPLETE: {part_no}/{total_parts} parts")
+    finally:
+        for task in [reader_task, *workers]:
+            if not task.done(): task.cancel()
+        # Download errors and cancels leave the sessions reusable; only their own failures close them
+        await MEDIA_SESSIONS.release(client, dc_id, sessions, broken=state["broken"])
+
+    if is_big:
+        input_file = raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    else:
+        input_file = raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum="")
+    return input_file, file_name
+
+async def send_uploaded_media(client: Client, acc, msg: Message, msg_type: str, input_file, file_name: str, dest_chat_id, dest_thread_id, caption, limit_key=None):
+    """
+    Sends an already uploaded InputFile/InputFileBig as a document, video or
+    audio mirroring `msg`. Paced by RATE_LIMITER under `limit_key` (defaults
+    to the bot's upload bucket for dest_chat_id). Returns the sent Message
+    (or True if it can't be parsed from the reply).
+    """
+    limit_key = limit_key or rate_key("bot", dest_chat_id, "upload")
+    media = msg.document or msg.video or msg.audio
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if msg_type == "Video":
+        attributes.append(raw.types.DocumentAttributeVideo(duration=msg.video.duration or 0, w=msg.video.width or 0, h=msg.video.height or 0, supports_streaming=True))
+    elif msg_type == "Audio":
+        attributes.append(raw.types.DocumentAttributeAudio(duration=msg.audio.duration or 0, title=msg.audio.title, performer=msg.audio.performer))
+
+    thumb_file = None
+    try:
+        if media.thumbs:
+            thumb_bytes = await acc.download_media(media.thumbs[0].file_id, in_memory=True)
+            thumb_file = await client.save_file(thumb_bytes)
+    except: pass
+
+    uploaded = raw.types.InputMediaUploadedDocument(
+        mime_type=media.mime_type or "application/octet-stream",
+        file=input_file,
+        thumb=thumb_file,
+        attributes=attributes,
+        force_file=msg_type == "Document"
+    )
+    while True:
+        await RATE_LIMITER.acquire(limit_key)
+        try:
+            updates = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(dest_chat_id),
+                    media=uploaded,
+                    reply_to=_thread_reply_to(dest_thread_id),
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption or "", None, None)
+                )
+            )
+            RATE_LIMITER.success(limit_key)
+            try: return await _sent_message(client, updates) or True
+            except Exception: return True
+        except FloodWait as e:
+            RATE_LIMITER.flood(limit_key, e.value)
+
+async def _sent_message(client: Client, updates):
+    """Parses the Message out of a raw SendMedia result (None if there is none)."""
+    users = {u.id: u for u in getattr(updates, "users", [])}
+    chats = {c.id: c for c in getattr(updates, "chats", [])}
+    for update in getattr(updates, "updates", []):
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await Message._parse(client, update.message, users, chats)
+    return None
+
+# ==============================================================================
+# --- MEDIA DEDUP CACHE: file_unique_id -> file_id of our first upload ---
+# ==============================================================================
+
+MEDIA_CACHE_STATS = {"hits": 0, "misses": 0, "stale": 0}
+
+def _message_media(msg):
+    msg_type = get_message_type(msg) if msg else None
+    if not msg_type or msg_type == "Text": return None
+    return getattr(msg, msg_type.lower(), None)
+
+def media_cache_hit_rate():
+    lookups = MEDIA_CACHE_STATS["hits"] + MEDIA_CACHE_STATS["misses"] + MEDIA_CACHE_STATS["stale"]
+    return (MEDIA_CACHE_STATS["hits"] / lookups * 100.0) if lookups else 0.0
+
+async def send_cached_copy(client: Client, unique_id, dest_chat_id, dest_thread_id, caption, turn=None) -> bool:
+    """
+    Resends a file the bot uploaded before, by file_id. Returns False on a
+    miss, or when the stored file_id no longer works (the entry is dropped
+    and the caller re-downloads). On a hit, `turn` is awaited before sending.
+    """
+    try:
+        cached = await db.get_cached_media(unique_id)
+    except Exception as e:
+        print(f"Media Cache Error: {e}")
+        return False
+    if not cached:
+        MEDIA_CACHE_STATS["misses"] += 1
+        return False
+
+    if turn: await turn()
+    send_key = rate_key("bot", dest_chat_id, "send")
+    while True:
+        await RATE_LIMITER.acquire(send_key)
+        try:
+            await client.send_cached_media(dest_chat_id, cached["file_id"], caption=caption, message_thread_id=dest_thread_id)
+            break
+        except FloodWait as e:
+            RATE_LIMITER.flood(send_key, e.value)
+        except Exception as e:
+            # FILE_REFERENCE_*, MEDIA_EMPTY, FILE_ID_INVALID...: the cached file is gone
+            if "FILE" in str(e) or "MEDIA" in str(e):
+                MEDIA_CACHE_STATS["stale"] += 1
+                try: await db.drop_cached_media(unique_id)
+                except Exception: pass
+            return False
+
+    RATE_LIMITER.success(send_key)
+    MEDIA_CACHE_STATS["hits"] += 1
+    try: await db.touch_cached_media(unique_id)
+    except Exception as e: print(f"Media Cache Error: {e}")
+    return True
+
+async def remember_media(unique_id, sent):
+    """Records the file_id of a message the bot just sent for `unique_id`."""
+    media = _message_media(sent) if isinstance(sent, Message) else None
+    if not unique_id or not media: return
+    try: await db.save_cached_media(unique_id, media.file_id, get_message_type(sent))
+    except Exception as e: print(f"Media Cache Error: {e}")
+
+# ==============================================================================
+# --- PARALLEL UPLOAD: saveBigFilePart over several media-DC connections ---
+# ==============================================================================
+
+MEDIA_SESSION_IDLE_TTL = 300  # Idle media sessions are closed after this many seconds
+
+class MediaSessionPool:
+    """
+    Media sessions per (client, dc), reused across transfers the way
+    pyrogram's client.media_sessions is. A foreign DC costs one auth key
+    exchange and one Export/ImportAuthorization per client instead of one
+    per file. Sessions come back through release() and stay open (up to
+    max_idle per DC) until idle_ttl passes or the client is dropped.
+    """
+    def __init__(self, max_idle, idle_ttl):
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self._pools = {}  # (id(client), dc_id) -> {client, auth_key, authorized, idle: [(session, since)], lock}
+
+    def _pool(self, client: Client, dc_id: int):
+        key = (id(client), dc_id)
+        pool = self._pools.get(key)
+        if pool is None or pool["client"] is not client:
+            pool = self._pools[key] = {"client": client, "auth_key": None, "authorized": False, "idle": [], "lock": asyncio.Lock()}
+        return pool
+
+    async def acquire(self, client: Client, dc_id: int, count: int):
+        """Returns `count` started, authorized media sessions to dc_id. Pair every call with release()."""
+        count = max(1, count)
+        pool = self._pool(client, dc_id)
+        sessions = []
+        while pool["idle"] and len(sessions) < count:
+            sessions.append(pool["idle"].pop()[0])
+        try:
+            if len(sessions) < count:
+                async with pool["lock"]:  # One key exchange / authorization per DC at a time
+                    test_mode = await client.storage.test_mode()
+                    if pool["auth_key"] is None:
+                        if dc_id != await client.storage.dc_id():
+                            pool["auth_key"] = await Auth(client, dc_id, test_mode).create()
+                        else:
+                            pool["auth_key"] = await client.storage.auth_key()
+                            pool["authorized"] = True
+                    while len(sessions) < count:
+                        session = Session(client, dc_id, pool["auth_key"], test_mode, is_media=True)
+                        await session.start()
+                        sessions.append(session)
+                        if not pool["authorized"]:
+                            exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                            await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+                            pool["authorized"] = True
+        except BaseException:
+            await self.release(client, dc_id, sessions, broken=True)
+            raise
+        return sessions
+
+    async def release(self, client: Client, dc_id: int, sessions, broken=False):
+        """Keeps healthy sessions for the next transfer; `broken` ones (the transfer failed) are closed."""
+        pool = self._pools.get((id(client), dc_id))
+        now = time.monotonic()
+        for session in sessions:
+            if broken or pool is None or pool["client"] is not client or len(pool["idle"]) >= self.max_idle:
+                await self._stop(session)
+            else:
+                pool["idle"].append((session, now))
+
+    async def close_client(self, client: Client):
+        """Closes the idle sessions of a client that is being disconnected; in-use ones close on release."""
+        for key, pool in list(self._pools.items()):
+            if pool["client"] is client:
+                del self._pools[key]
+                for session, _ in pool["idle"]:
+                    await self._stop(session)
+
+    async def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        for pool in list(self._pools.values()):
+            stale = [session for session, since in pool["idle"] if since < cutoff]
+            pool["idle"] = [(session, since) for session, since in pool["idle"] if since >= cutoff]
+            for session in stale:
+                await self._stop(session)
+
+    async def reaper(self):
+        """Background loop that closes media sessions idle for longer than idle_ttl"""
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                print(f"Media Session Reaper Error: {e}")
+
+    @staticmethod
+    async def _stop(session):
+        try: await session.stop()
+        except: pass
+
+MEDIA_SESSIONS = MediaSessionPool(max_idle=max(UPLOAD_CONNECTIONS, DOWNLOAD_CONNECTIONS), idle_ttl=MEDIA_SESSION_IDLE_TTL)
+
+PARALLEL_UPLOAD_MIN_SIZE = 20 * 1024 * 1024  # Below this a single connection is just as fast
+
+async def parallel_upload(client: Client, file, file_size: int, file_name: str, status_message: Message = None, task_uuid=None, connections: int = None):
+    """
+    Uploads a path or FileSlice, spreading parts across `connections` media
+    sessions: saveBigFilePart above 10 MB, saveFilePart otherwise (e.g. the
+    tail slice of a split). A worker that hits FloodWait requeues its part,
+    sleeps, and retires if others are still running, so concurrency backs off
+    under pressure. If the parallel path fails it falls back to pyrogram's
+    save_file. Returns the InputFile/InputFileBig for SendMedia.
+    """
+    connections = max(1, connections or UPLOAD_CONNECTIONS)
+    source = file if isinstance(file, FileSlice) else FileSlice(file, 0, file_size, name=file_name)
+    try:
+        try:
+            return await _parallel_save_parts(client, source, file_size, file_name, status_message, task_uuid, connections)
+        except Exception as e:
+            if "CANCELLED" in str(e): raise
+            print(f"Parallel upload failed, using pyrogram save_file: {e}")
+        source.seek(0)
+        progress_args = (status_message, "up", task_uuid)
+        return await client.save_file(source, progress=progress if status_message is not None else None, progress_args=progress_args)
+    finally:
+        if source is not file:
+            source.close()
+
+async def _parallel_save_parts(client: Client, source: FileSlice, file_size: int, file_name: str, status_message, task_uuid, connections: int):
+    is_big = file_size > STREAM_BIG_FILE
+    total_parts = max(1, -(-file_size // STREAM_PART_SIZE))
+    file_id = client.rnd_id()
+    loop = asyncio.get_running_loop()
+
+    pending = asyncio.Queue()
+    for part_no in range(total_parts):
+        pending.put_nowait(part_no)
+    state = {"uploaded": 0, "workers": 0}
+
+    async def worker(session):
+        state["workers"] += 1
+        try:
+            while True:
+                try: part_no = pending.get_nowait()
+                except asyncio.QueueEmpty: return
+                data = await loop.run_in_executor(io_executor, source.pread, STREAM_PART_SIZE, part_no * STREAM_PART_SIZE)
+                if is_big:
+                    request = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=part_no, file_total_parts=total_parts, bytes=data)
+                else:
+                    request = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part_no, bytes=data)
+                try:
+                    for attempt in range(3):
+                        try:
+                            await session.invoke(request)
+                            break
+                        except FloodWait: raise
+                        except Exception:
+                            if attempt == 2: raise
+                            await asyncio.sleep(1)
+                except FloodWait as e:
+                    pending.put_nowait(part_no)
+                    await asyncio.sleep(e.value + 1)
+                    if state["workers"] > 1: return
+                    continue
+                state["uploaded"] += len(data)
+                if status_message is not None:
+                    progress(state["uploaded"], file_size, status_message, "up", task_uuid)
+        finally:
+            state["workers"] -= 1
+
+    dc_id = await client.storage.dc_id()
+    sessions = []
+    done = False
+    try:
+        sessions = await MEDIA_SESSIONS.acquire(client, dc_id, min(connections, total_parts))
+        workers = [asyncio.create_task(worker(session)) for session in sessions]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                if not w.done(): w.cancel()
+        # Retired workers can leave requeued parts behind; finish them on one connection
+        if not pending.empty():
+            await worker(sessions[0])
+        done = True
+    finally:
+        await MEDIA_SESSIONS.release(client, dc_id, sessions, broken=not done)
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum="")
+
+# ==============================================================================
+# --- PARALLEL DOWNLOAD: ranged upload.getFile over several media-DC connections ---
+# ==============================================================================
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # getFile maximum; chunks stay 1 MB aligned
+PARALLEL_DOWNLOAD_MIN_SIZE = 20 * 1024 * 1024
+
+def _document_location(msg: Message):
+    media = msg.document or msg.video or msg.audio
+    file_id = FileId.decode(media.file_id)
+    location = raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=""
+    )
+    return file_id.dc_id, location
+
+async def parallel_download(acc, msg: Message, file_path, file_size: int, status_message: Message = None, task_uuid=None, refresh=None, on_prefix=None, connections: int = None):
+    """
+    Downloads a document/video/audio with concurrent getFile requests for
+    disjoint 1 MB ranges, written with os.pwrite into a preallocated file.
+
+    refresh:   coroutine function returning a re-fetched Message, used once per
+               FileReferenceExpired to renew the file reference for all workers.
+    on_prefix: called with the number of contiguous bytes on disk from offset 0.
+    Raises on CDN redirects so callers can fall back to acc.download_media.
+    """
+    loop = asyncio.get_running_loop()
+    done_chunks = set()
+    state = {"prefix": 0}
+
+    async def write_chunk(chunk_no, data):
+        await loop.run_in_executor(io_executor, os.pwrite, fd, data, chunk_no * DOWNLOAD_CHUNK_SIZE)
+        done_chunks.add(chunk_no)
+        while state["prefix"] in done_chunks:
+            state["prefix"] += 1
+        if on_prefix:
+            on_prefix(min(state["prefix"] * DOWNLOAD_CHUNK_SIZE, file_size))
+
+    fd = await _fs(os.open, str(file_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        await _fs(os.ftruncate, fd, file_size)
+        await _parallel_get_file(acc, msg, file_size, write_chunk, status_message, task_uuid, refresh, connections)
+    finally:
+        os.close(fd)
+    return str(file_path)
+
+async def parallel_stream_media(acc, msg: Message, file_size: int, refresh=None, connections: int = None):
+    """
+    Like acc.stream_media(msg), but the 1 MB chunks are fetched concurrently
+    over `connections` media sessions and yielded in order. Workers run at
+    most STREAM_BUFFER_CHUNKS chunks ahead of the consumer.
+    """
+    window = asyncio.Semaphore(STREAM_BUFFER_CHUNKS)
+    chunks = {}
+    arrived = asyncio.Event()
+
+    async def keep_chunk(chunk_no, data):
+        chunks[chunk_no] = data
+        arrived.set()
+
+    async def fetch():
+        try:
+            await _parallel_get_file(acc, msg, file_size, keep_chunk, None, None, refresh, connections, window)
+        finally:
+            arrived.set()
+
+    fetcher = asyncio.create_task(fetch())
+    try:
+        for chunk_no in range(max(1, -(-file_size // DOWNLOAD_CHUNK_SIZE))):
+            while chunk_no not in chunks:
+                if fetcher.done():
+                    fetcher.result()  # Raises the workers' error
+                    raise Exception(f"DOWNLOAD_INCOMPLETE: chunk {chunk_no} missing")
+                arrived.clear()
+                await arrived.wait()
+            data = chunks.pop(chunk_no)
+            window.release()
+            yield data
+        await fetcher
+    finally:
+        if not fetcher.done():
+            fetcher.cancel()
+
+async def _parallel_get_file(acc, msg: Message, file_size: int, sink, status_message=None, task_uuid=None, refresh=None, connections: int = None, window=None):
+    # Workers take chunk numbers in order and hand each (chunk_no, bytes) to `sink`.
+    # `window` (a Semaphore the consumer releases) bounds how far ahead they fetch.
+    connections = max(1, connections or DOWNLOAD_CONNECTIONS)
+    dc_id, location = _document_location(msg)
+    total_chunks = max(1, -(-file_size // DOWNLOAD_CHUNK_SIZE))
+
+    pending = asyncio.Queue()
+    for chunk_no in range(total_chunks):
+        pending.put_nowait(chunk_no)
+    state = {"downloaded": 0, "location": location}
+    refresh_lock = asyncio.Lock()
+
+    async def refresh_location(stale):
+        async with refresh_lock:
+            if state["location"] is stale:  # Another worker may already have renewed it
+                fresh = await refresh()
+                state["location"] = _document_location(fresh)[1]
+
+    async def worker(session):
+        while True:
+            if window is not None:
+                await window.acquire()
+            try: chunk_no = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                if window is not None: window.release()
+                return
+            offset = chunk_no * DOWNLOAD_CHUNK_SIZE
+            for attempt in range(5):
+                current = state["location"]
+                try:
+                    r = await session.invoke(raw.functions.upload.GetFile(location=current, offset=offset, limit=DOWNLOAD_CHUNK_SIZE))
+                    break
+                except FileReferenceExpired:
+                    if refresh is None: raise
+                    await refresh_location(current)
+                except FloodWait as e:
+                    await asyncio.sleep(e.value + 1)
+                except Exception:
+                    if attempt == 4: raise
+                    await asyncio.sleep(1)
+            else:
+                raise Exception(f"DOWNLOAD_RETRIES_EXHAUSTED at offset {offset}")
+
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                raise Exception("CDN_REDIRECT")
+            await sink(chunk_no, r.bytes)
+
+            state["downloaded"] += len(r.bytes)
+            if status_message is not None:
+                progress(state["downloaded"], file_size, status_message, "down", task_uuid)
+
+    sessions = []
+    done = False
+    try:
+        sessions = await MEDIA_SESSIONS.acquire(acc, dc_id, min(connections, total_chunks))
+        workers = [asyncio.create_task(worker(session)) for session in sessions]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                if not w.done(): w.cancel()
+        done = True
+    finally:
+        await MEDIA_SESSIONS.release(acc, dc_id, sessions, broken=not done)
+
+# ==============================================================================
+# --- handle_private: downloads & uploads with per-task cancel checks ---
+# ==============================================================================
+
+async def handle_private(client: Client, acc, message: Message, chatid, msgid: int, index: int, total_count: int, status_message: Message, dest_chat_id, dest_thread_id, delay, user_id, task_uuid=None, msg: Message = None, turn=None):
+    # `msg` is passed in when the batch prefetcher already fetched it
+    # `turn` (pipelined batches) is awaited before anything is sent, so deliveries keep source order
+    if turn is None: turn = _no_turn
+    if msg is None:
+        try:
+            msg = await acc.get_messages(chatid, msgid)
+        except UserNotParticipant: return False
+        except AuthKeyUnregistered: raise
+        except Exception: return False
 
     if msg.empty: return False
     msg_type = get_message_type(msg)
@@ -1504,28 +4035,50 @@ async def handle_private(client: Client, acc, message: Message, chatid, msgid: i
 
     if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): return False
 
-    # 1. FAST FORWARD (Copy)
-    if not msg.chat.has_protected_content:
+    # 1. FAST FORWARD (Copy) - routed by the cached chat capabilities
+    caps = CHAT_CAPS.observe(user_account(user_id), chatid, msg)
+    if caps.forwardable and not getattr(msg, "has_protected_content", False):
         try:
-            await acc.copy_message(chat_id=dest_chat_id, from_chat_id=chatid, message_id=msgid, message_thread_id=dest_thread_id)
+            copy_key = rate_key(user_account(user_id), dest_chat_id, "copy")
+            await turn()
+            await RATE_LIMITER.acquire(copy_key)  # Before the slot: a blocked bucket must not hold a global slot
+            async with SCHEDULER.slot("forward", user_id):
+                with M_STAGE.time(stage="copy"):
+                    await acc.copy_message(chat_id=dest_chat_id, from_chat_id=chatid, message_id=msgid, message_thread_id=dest_thread_id)
+            RATE_LIMITER.success(copy_key)
             return True # Success
         except FloodWait as e:
+            RATE_LIMITER.flood(copy_key, e.value)
             raise e # Raise to main loop
-        except Exception:
-            pass # Fallback to download
+        except Exception as e:
+            # Chat turned protected since it was cached: stop trying copy for the rest of it
+            if "CHAT_FORWARDS_RESTRICTED" in str(e):
+                CHAT_CAPS.update(user_account(user_id), chatid, protected=True)
+            # Fallback to download
 
     if "Text" == msg_type:
+        send_key = rate_key("bot", dest_chat_id, "send")
         try: 
+            await turn()
+            await RATE_LIMITER.acquire(send_key)
             await client.send_message(dest_chat_id, msg.text, entities=msg.entities, message_thread_id=dest_thread_id)
+            RATE_LIMITER.success(send_key)
+        except FloodWait as e:
+            RATE_LIMITER.flood(send_key, e.value)
         except: pass
         return True
 
-    # 2. DOWNLOAD & UPLOAD
-    asyncio.create_task(downstatus(client, status_message, message.chat.id, index, total_count))
-    
+    # 2. DEDUP CACHE: the bot already uploaded this exact file -> resend it by file_id
+    media = _message_media(msg)
+    unique_id = media.file_unique_id if MEDIA_CACHE and media else None
+    if unique_id:
+        if await send_cached_copy(client, unique_id, dest_chat_id, dest_thread_id, msg.caption[:1024] if msg.caption else None, turn=turn):
+            return True
+
+    # 3. DOWNLOAD & UPLOAD
     task_id = status_message.id
-    task_folder_path = Path(f"./downloads/{user_id}/{task_id}/")
-    task_folder_path.mkdir(parents=True, exist_ok=True)
+    task_folder_path = Path(f"./downloads/{user_id}/{task_id}/{msgid}/")  # Per message: pipelined units share the task
+    await fs_mkdir(task_folder_path)
 
     original_filename = "unknown_file.dat"
     if msg.document and msg.document.file_name: original_filename = msg.document.file_name
@@ -1549,11 +4102,19 @@ async def handle_private(client: Client, acc, message: Message, chatid, msgid: i
         if me.is_premium: split_limit = 4000 * 1024 * 1024 
     except: pass
 
+    tracker = PROGRESS_HUB.begin(client, status_message, message.chat.id, "down", index, total_count, unit=msgid)
     try: 
+        msg_fresh = msg
+        refresh_ref = False
+        use_stream = STREAM_MODE and msg_type in ("Document", "Video", "Audio")
+        refetch = lambda: acc.get_messages(chatid, msgid)
         for attempt in range(3):
             if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): return False
             try:
-                msg_fresh = await acc.get_messages(chatid, msgid)
+                # Only re-fetch when the file reference actually expired
+                if refresh_ref:
+                    msg_fresh = await acc.get_messages(chatid, msgid)
+                    refresh_ref = False
                 if msg_fresh.empty: return False
                 
                 # Get size safely
@@ -1562,29 +4123,103 @@ async def handle_private(client: Client, acc, message: Message, chatid, msgid: i
                 elif msg_fresh.video: file_size = msg_fresh.video.file_size
                 elif msg_fresh.audio: file_size = msg_fresh.audio.file_size
 
+                if use_stream and 0 < file_size <= STREAM_MAX_SIZE:
+                    caption = msg.caption[:1024] if msg.caption else None
+                    try:
+                        # Download and part uploads run ahead of our turn (no disk, so under
+                        # the download pool); only the SendMedia that delivers it waits.
+                        async with SCHEDULER.slot("download", user_id), M_STAGE.time(stage="stream"):
+                            input_file, file_name = await stream_upload(client, acc, msg_fresh, tracker, task_uuid, refresh=refetch)
+                        M_BYTES.inc(file_size, direction="down")
+                        M_BYTES.inc(file_size, direction="up")
+                        await turn()
+                        sent = await send_uploaded_media(client, acc, msg_fresh, msg_type, input_file, file_name, dest_chat_id, dest_thread_id, caption)
+                        await remember_media(unique_id, sent)
+                        return bool(sent)
+                    except (FloodWait, FileReferenceExpired): raise
+                    except Exception as e:
+                        if "CANCELLED" in str(e): raise
+                        # Anything else: retry this message through the disk path
+                        print(f"Stream transfer failed, falling back to disk: {e}")
+                        use_stream = False
+                        raise
+
                 if file_size > split_limit:
-                    file_path = await acc.download_media(msg_fresh, file_name=str(file_path_to_save), progress=progress, progress_args=[status_message, "down", task_uuid])
-                    await status_message.edit_text(f"Processing large file ({_pretty_bytes(file_size)})... Splitting 🔪")
-                    parts = await split_file_python(file_path, chunk_size=1900*1024*1024)
-                    
+                    # Virtual split: each part is a FileSlice over the file being downloaded,
+                    # uploaded as soon as the download passes its end offset.
+                    file_path = str(file_path_to_save)
+                    parts = make_file_slices(file_path, file_size, 1900*1024*1024)
+                    parts_ready = [asyncio.Event() for _ in parts]
+
+                    async def split_download():
+                        # Runs ahead of our turn, so it takes a download slot like any other download
+                        try:
+                            async with SCHEDULER.slot("download", user_id):
+                                await download_into_slices(acc, msg_fresh, file_path, file_size, parts, parts_ready, tracker, task_uuid, refresh=refetch)
+                        finally:
+                            for event in parts_ready: event.set()
+
+                    # DISK_FULL (retried) if the downloads in flight would overcommit the disk
+                    await DISK_BUDGET.reserve(file_size)
+                    download_task = asyncio.create_task(split_download())
+
                     caption = msg.caption[:1024] if msg.caption else ""
-                    async with USER_UPLOAD_LOCKS[user_id]:
-                        async with UPLOAD_SEMAPHORE:
-                            for part in parts:
-                                if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): raise Exception("CANCELLED")
-                                while True:
-                                    try:
-                                        await client.send_document(dest_chat_id, str(part), caption=caption, message_thread_id=dest_thread_id)
-                                        break
-                                    except FloodWait as e: await asyncio.sleep(e.value + 5)
-                                    except Exception: break
-                                try: os.remove(part)
-                                except: pass
-                    try: os.remove(file_path)
-                    except: pass
+                    split_start = time.perf_counter()
+                    try:
+                        try: await status_message.edit_text(f"Processing large file ({_pretty_bytes(file_size)})... Uploading in {len(parts)} parts 🔪")
+                        except: pass
+                        await turn()  # The download keeps running while earlier messages are delivered
+                        # The upload slot is held per part transfer only: not while a part
+                        # downloads, while SendMedia waits for a token, or over a FloodWait
+                        for part, part_ready in zip(parts, parts_ready):
+                            if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): raise Exception("CANCELLED")
+                            await part_ready.wait()
+                            if download_task.done() and download_task.exception(): raise download_task.exception()
+                            use_raw = True
+                            while True:
+                                try:
+                                    if use_raw:
+                                        async with SCHEDULER.slot("upload", user_id):
+                                            input_file = await parallel_upload(client, part, part.length, part.name, tracker, task_uuid)
+                                        await send_uploaded_media(client, acc, msg, "Document", input_file, part.name, dest_chat_id, dest_thread_id, caption)
+                                    else:
+                                        part.seek(0)
+                                        async with SCHEDULER.slot("upload", user_id):
+                                            await client.send_document(dest_chat_id, part, file_name=part.name, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[tracker, "up", task_uuid])
+                                    M_BYTES.inc(part.length, direction="up")
+                                    break
+                                except FloodWait as e:
+                                    M_FLOODWAIT.inc(e.value, method="split_upload")
+                                    await asyncio.sleep(e.value + 5)
+                                except Exception as e:
+                                    if "CANCELLED" in str(e): raise
+                                    if not use_raw: break
+                                    # Raw SendMedia path failed: retry this part once through send_document
+                                    print(f"Split part upload failed, using send_document: {e}")
+                                    use_raw = False
+                            part.close()
+                        await download_task
+                        M_BYTES.inc(file_size, direction="down")
+                    finally:
+                        M_STAGE.observe(time.perf_counter() - split_start, stage="split")
+                        if not download_task.done(): download_task.cancel()
+                        for part in parts: part.close()
+                        try: await fs_remove(file_path)
+                        except: pass
+                        DISK_BUDGET.release(file_size)
                     return True 
                 else:
-                    file_path = await acc.download_media(msg_fresh, file_name=str(file_path_to_save), progress=progress, progress_args=[status_message, "down", task_uuid])
+                    file_path = None
+                    async with SCHEDULER.slot("download", user_id), M_STAGE.time(stage="download"):
+                        if DOWNLOAD_CONNECTIONS > 1 and file_size >= PARALLEL_DOWNLOAD_MIN_SIZE and msg_type in ("Document", "Video", "Audio"):
+                            try:
+                                file_path = await parallel_download(acc, msg_fresh, file_path_to_save, file_size, tracker, task_uuid, refresh=refetch)
+                            except FloodWait: raise
+                            except Exception as e:
+                                if "CANCELLED" in str(e): raise
+                                print(f"Parallel download failed, using single connection: {e}")
+                        if not file_path:
+                            file_path = await acc.download_media(msg_fresh, file_name=str(file_path_to_save), progress=progress, progress_args=[tracker, "down", task_uuid])
                 
                 try:
                     thumb = None
@@ -1596,7 +4231,10 @@ async def handle_private(client: Client, acc, message: Message, chatid, msgid: i
 
                 download_success = True
                 break
+            except FileReferenceExpired:
+                refresh_ref = True
             except FloodWait as e:
+                M_FLOODWAIT.inc(e.value, method="download")
                 await asyncio.sleep(e.value + 5)
             except Exception as e:
                 if "CANCELLED" in str(e): return False
@@ -1605,36 +4243,63 @@ async def handle_private(client: Client, acc, message: Message, chatid, msgid: i
         if not download_success: return False
         if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): return False
 
-        asyncio.create_task(upstatus(client, status_message, message.chat.id, index, total_count))
+        PROGRESS_HUB.begin(client, status_message, message.chat.id, "up", index, total_count, unit=msgid)
         caption = msg.caption[:1024] if msg.caption else None
-        if file_path and not os.path.exists(file_path): return True
+        if file_path and not await fs_exists(file_path): return True
 
         uploader = client
-        if os.path.getsize(file_path) > 2000 * 1024 * 1024: uploader = acc 
+        upload_size = await fs_getsize(file_path)
+        M_BYTES.inc(upload_size, direction="down")
+        if upload_size > 2000 * 1024 * 1024: uploader = acc 
+        use_parallel = UPLOAD_CONNECTIONS > 1 and msg_type in ("Document", "Video", "Audio") and upload_size >= PARALLEL_UPLOAD_MIN_SIZE
+        upload_key = rate_key("bot" if uploader is client else user_account(user_id), dest_chat_id, "upload")
 
         upload_success = False
-        async with USER_UPLOAD_LOCKS[user_id]:
-            async with UPLOAD_SEMAPHORE:
-                while True:
-                    if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): break
-                    try:
-                        if "Document" == msg_type: await uploader.send_document(dest_chat_id, file_path, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[status_message,"up", task_uuid])
-                        elif "Video" == msg_type: await uploader.send_video(dest_chat_id, file_path, duration=msg.video.duration, width=msg.video.width, height=msg.video.height, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[status_message,"up", task_uuid])
-                        elif "Audio" == msg_type: await uploader.send_audio(dest_chat_id, file_path, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[status_message,"up", task_uuid])
-                        elif "Photo" == msg_type: await uploader.send_photo(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id)
-                        elif "Voice" == msg_type: await uploader.send_voice(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[status_message,"up", task_uuid])
-                        elif "Animation" == msg_type: await uploader.send_animation(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id)
-                        elif "Sticker" == msg_type: await uploader.send_sticker(dest_chat_id, file_path, message_thread_id=dest_thread_id)
+        sent = None
+        # Wait for our turn before taking the (one per user) upload slot, never while holding it.
+        # The slot covers the transfer only: rate tokens (which FloodWait can block for minutes)
+        # are taken before it, so throttled users do not pin the global UPLOAD_SLOTS.
+        await turn()
+        with M_STAGE.time(stage="upload"):
+            while True:
+                if batch_temp.IS_BATCH.get(user_id) or (task_uuid and CANCEL_FLAGS.get(task_uuid)): break
+                try:
+                    if use_parallel:
+                        upload_name = os.path.basename(file_path)
+                        async with SCHEDULER.slot("upload", user_id):
+                            input_file = await parallel_upload(uploader, file_path, upload_size, upload_name, tracker, task_uuid)
+                        sent = await send_uploaded_media(uploader, acc, msg, msg_type, input_file, upload_name, dest_chat_id, dest_thread_id, caption, limit_key=upload_key)
                         upload_success = True
-                        break 
-                    except Exception as e:
-                        if "CANCELLED" in str(e): break
-                        if isinstance(e, FloodWait): await asyncio.sleep(e.value + 5)
-                        else: break
+                        break
+                    await RATE_LIMITER.acquire(upload_key)
+                    async with SCHEDULER.slot("upload", user_id):
+                        if "Document" == msg_type: sent = await uploader.send_document(dest_chat_id, file_path, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[tracker, "up", task_uuid])
+                        elif "Video" == msg_type: sent = await uploader.send_video(dest_chat_id, file_path, duration=msg.video.duration, width=msg.video.width, height=msg.video.height, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[tracker, "up", task_uuid])
+                        elif "Audio" == msg_type: sent = await uploader.send_audio(dest_chat_id, file_path, thumb=ph_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[tracker, "up", task_uuid])
+                        elif "Photo" == msg_type: sent = await uploader.send_photo(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id)
+                        elif "Voice" == msg_type: sent = await uploader.send_voice(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id, progress=progress, progress_args=[tracker, "up", task_uuid])
+                        elif "Animation" == msg_type: sent = await uploader.send_animation(dest_chat_id, file_path, caption=caption, message_thread_id=dest_thread_id)
+                        elif "Sticker" == msg_type: sent = await uploader.send_sticker(dest_chat_id, file_path, message_thread_id=dest_thread_id)
+                    RATE_LIMITER.success(upload_key)
+                    upload_success = True
+                    break 
+                except Exception as e:
+                    if "CANCELLED" in str(e): break
+                    if isinstance(e, FloodWait): RATE_LIMITER.flood(upload_key, e.value)
+                    elif use_parallel:
+                        # Raw SendMedia path failed: retry once through pyrogram's send_* methods
+                        print(f"Parallel upload send failed, using {msg_type} send: {e}")
+                        use_parallel = False
+                    else: break
+        if upload_success: M_BYTES.inc(upload_size, direction="up")
+        # Only the bot's file_ids are reusable by send_cached_media later
+        if upload_success and uploader is client:
+            await remember_media(unique_id, sent)
         return upload_success
 
     finally:
-        try: shutil.rmtree(task_folder_path)
+        PROGRESS_HUB.end(status_message.id, unit=msgid)
+        try: await TREE_DELETER.discard(task_folder_path)
         except: pass
         gc.collect()
 
@@ -1649,6 +4314,12 @@ except ImportError:
 async def _koyeb_health_handler(request):
     return web.Response(text="OK", status=200)
 
+async def _metrics_handler(request):
+    return web.Response(
+        body=METRICS.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
 async def start_koyeb_health_check(host: str = "0.0.0.0", port: int | str = 8080):
     if web is None:
         print("aiohttp not installed; Koyeb health check not started.")
@@ -1660,6 +4331,7 @@ async def start_koyeb_health_check(host: str = "0.0.0.0", port: int | str = 8080
     app_web = web.Application()
     app_web.router.add_get("/", _koyeb_health_handler)
     app_web.router.add_get("/health", _koyeb_health_handler)
+    app_web.router.add_get("/metrics", _metrics_handler)
     runner = web.AppRunner(app_web)
     await runner.setup()
     site = web.TCPSite(runner, host, port)
@@ -1671,9 +4343,11 @@ async def start_koyeb_health_check(host: str = "0.0.0.0", port: int | str = 8080
 # ==============================================================================
 
 async def main():
-    if os.path.exists("./downloads"):
+    # Old downloads are renamed into the trash and deleted in the background
+    asyncio.create_task(TREE_DELETER.run())
+    if await fs_exists("./downloads"):
         try:
-            shutil.rmtree("./downloads")
+            await TREE_DELETER.discard("./downloads")
             print("✅ Cleanup: Deleted old downloads folder.")
         except Exception as e:
             print(f"⚠️ Cleanup Error: {e}")
@@ -1681,9 +4355,15 @@ async def main():
     # START THE WATCHDOG HERE
     asyncio.create_task(cleanup_watchdog())
     print("🛡️ Auto-Cleanup Watchdog Started")
+    asyncio.create_task(USER_CLIENTS.reaper())
+    asyncio.create_task(MEDIA_SESSIONS.reaper())
+    asyncio.create_task(LOOP_MONITOR.run())
 
+    await db.ensure_indexes()
     await app.start()
     print("Bot Started")
+    asyncio.create_task(resume_unfinished_tasks(app))
+    asyncio.create_task(BROADCASTER.resume(app))
     asyncio.create_task(start_koyeb_health_check())
     await idle()
     await app.stop()